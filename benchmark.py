@@ -0,0 +1,500 @@
+"""Benchmarks for the figure extraction pipeline.
+
+The render command compares the rendering backends. Every backend runs in
+a separate process so that the peak memory of one backend does not affect
+the others. The labels command compares the label generation with the
+previous implementation that drew one box at a time on synthetic figures.
+
+The suite command runs the stages of the pipeline (render_chart,
+gen_labeled_image, synthesize_label, find_bad.check, rate.calculate_diff
+and run_local) on a fixed corpus: the figures of testdata/paper.pdf in
+testoutput/json and synthetic figures with many text boxes. It needs no
+network and no GPU. pdffigures is not run, run_local gets the stored
+figures. Every benchmark runs in its own process and reports latency
+percentiles, throughput and peak memory. The results are written as JSON
+(by default to benchmark-COMMIT.json) and the compare command shows the
+differences between two result files, e.g. of two commits. It exits with
+status 1 if a benchmark got slower or needs more memory than the tolerance
+allows.
+
+Usage:
+  benchmark.py render [FILE] [--renderer=NAME]... [--dpi=DPI] [--repeat=N]
+  benchmark.py labels [--boxes=N] [--figures=N]
+  benchmark.py suite [FILE] [--renderer=NAME]... [--repeat=N] [--boxes=N] [--figures=N] [--only=NAMES] [--output=FILE]
+  benchmark.py compare BASELINE RESULTS [--tolerance=PERCENT]
+  benchmark.py (-h | --help)
+
+Options:
+  --renderer=NAME       Backends to compare [default: wand mupdf].
+  --dpi=DPI             Resolution to rasterize pages at [default: 200].
+  --repeat=N            How often to rasterize every page [default: 3].
+  --boxes=N             Number of text boxes per figure [default: 300].
+  --figures=N           Number of figures [default: 200].
+  --only=NAMES          Comma separated benchmarks to run, e.g.
+                        find_bad,render_chart.
+  --output=FILE         Write the results to this file.
+  --tolerance=PERCENT   Allowed slowdown or memory growth [default: 10].
+  -h --help             Show this screen.
+"""
+
+import contextlib
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import multiprocessing
+import resource
+import time
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+from docopt import docopt
+
+import render
+import label_image
+import find_bad
+import rate
+
+
+CORPUS_FIGURES = 'testoutput/json'
+
+PERCENTILES = (50, 90, 99)
+
+# thresholds that the suite compares predictions with
+THRESHOLDS = [100, 150, 200]
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB."""
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _bench_renderer(name, pdf_file, dpi, repeat):
+    baseline = peak_rss()
+    renderer = render.get_renderer(name)
+
+    latencies = []
+    for _ in range(repeat):
+        for page in range(renderer.page_count(pdf_file)):
+            start = time.time()
+            renderer.rasterize(pdf_file, page, dpi)
+            latencies.append(time.time() - start)
+
+    renderer.close()
+    return latencies, baseline, peak_rss()
+
+
+def bench_render(pdf_file, renderers, dpi, repeat):
+    for name in renderers:
+        pool = multiprocessing.Pool(1)
+        try:
+            latencies, baseline, peak = pool.apply(
+                _bench_renderer, (name, pdf_file, dpi, repeat))
+        except ImportError as e:
+            print("{}: not available ({})".format(name, e))
+            continue
+        finally:
+            pool.terminate()
+
+        latencies = np.array(latencies) * 1000
+        print("{}: {} pages, mean {:.1f} ms, median {:.1f} ms, max {:.1f} ms "
+              "per page, peak RSS {:.1f} MB ({:.1f} MB above baseline)".format(
+                  name, len(latencies), np.mean(latencies),
+                  np.median(latencies), np.max(latencies),
+                  peak, peak - baseline))
+
+
+def synthetic_figure(boxes, width=600, height=400, seed=0):
+    """Creates the description of a figure with many small text boxes,
+    like the JSON that pdffigures writes for a dense plot.
+    """
+
+    rng = np.random.RandomState(seed)
+    x0, y0 = 100, 150
+
+    texts = []
+    for _ in range(boxes):
+        w, h = rng.uniform(5, 40), rng.uniform(5, 14)
+        x, y = rng.uniform(0, width - w), rng.uniform(0, height - h)
+        texts.append({
+            'Rotation': 0,
+            'TextBB': [x0 + x, y0 + y, x0 + x + w, y0 + y + h],
+            'Text': 'label'})
+
+    return {
+        'Page': 1,
+        'ImageBB': [x0, y0, x0 + width, y0 + height],
+        'ImageText': texts}
+
+
+def legacy_label(description):
+    """The label generation before it was vectorized, for comparison."""
+
+    bounds = np.array(description['ImageBB'])
+    x0 = bounds[0]
+    y0 = bounds[1]
+    w = bounds[2] - x0
+    h = bounds[3] - y0
+
+    label = np.zeros((h, w), np.uint8)
+    for text_box in description['ImageText']:
+        tb = np.array(text_box['TextBB'])
+        tx0 = int(math.floor(tb[0] - x0))
+        ty0 = int(math.floor(tb[1] - y0))
+        tx1 = int(math.ceil(tb[2] - x0))
+        ty1 = int(math.ceil(tb[3] - y0))
+
+        # -1 is a filled rectangle
+        cv2.rectangle(label, (tx0, ty0), (tx1, ty1), label_image.WHITE, -1)
+
+    kernel = np.ones((2, 2), np.uint8)
+    return cv2.dilate(label, kernel, iterations=2)
+
+
+def _labels_per_second(generate, figures):
+    start = time.time()
+    generate(figures)
+    return len(figures) / (time.time() - start)
+
+
+def bench_labels(boxes, count):
+    figures = [synthetic_figure(boxes, seed=i) for i in range(count)]
+
+    for figure in figures[:10]:
+        assert np.array_equal(legacy_label(figure),
+                              label_image.gen_label(figure))
+
+    results = [
+        ('one box at a time', lambda fs: [legacy_label(f) for f in fs]),
+        ('vectorized', lambda fs: [label_image.gen_label(f) for f in fs]),
+        ('vectorized batch', label_image.gen_labels),
+    ]
+    for name, generate in results:
+        print("{}: {:.1f} labels/s ({} boxes per label)".format(
+            name, _labels_per_second(generate, figures), boxes))
+
+
+def corpus_figures(json_dir=CORPUS_FIGURES):
+    """Reads the figures that pdffigures found in the test paper, ordered
+    by their index.
+    """
+    names = [n for n in os.listdir(json_dir) if '-Figure-' in n]
+    names.sort(key=lambda n: int(n.rsplit('-Figure-', 1)[1].split('.')[0]))
+    figures = []
+    for name in names:
+        with open(os.path.join(json_dir, name)) as f:
+            figures.append(json.load(f))
+    return figures
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Hides the progress and the results that the stages print."""
+    stdout, stderr = sys.stdout, sys.stderr
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+def _timed(call, latencies):
+    start = time.time()
+    result = call()
+    latencies.append(time.time() - start)
+    return result
+
+
+def suite_render_chart(options, renderer_name):
+    """Renders every figure of the paper at 100 and 200 DPI. Every repeat
+    starts with an empty page cache.
+    """
+    figures = corpus_figures()
+    renderer = render.get_renderer(renderer_name)
+    scratch = tempfile.mkdtemp()
+    latencies = []
+    try:
+        for _ in range(options['repeat']):
+            cache = render.PageCache(renderer=renderer)
+            for i, figure in enumerate(figures):
+                for dpi in (100, 200):
+                    target = os.path.join(scratch, '{}-{}.png'.format(i, dpi))
+                    _timed(lambda: render.render_chart(
+                        options['pdf'], figure['Page'] - 1, figure['ImageBB'],
+                        dpi, target, cache), latencies)
+    finally:
+        renderer.close()
+        shutil.rmtree(scratch)
+    return latencies, 'charts'
+
+
+def suite_labels(options):
+    """Writes the label images of the synthetic figures."""
+    figures = [synthetic_figure(options['boxes'], seed=i)
+               for i in range(options['figures'])]
+    scratch = tempfile.mkdtemp()
+    latencies = []
+    try:
+        for _ in range(options['repeat']):
+            for i, figure in enumerate(figures):
+                target = os.path.join(scratch, '{}-label.png'.format(i))
+                _timed(lambda: label_image.gen_labeled_image(
+                    figure, None, target), latencies)
+    finally:
+        shutil.rmtree(scratch)
+    return latencies, 'labels'
+
+
+def suite_synthesize_label(options):
+    """Computes the labels of the synthetic figures from their description
+    at twice the size, as for images rendered at 200 DPI.
+    """
+    figures = [synthetic_figure(options['boxes'], seed=i)
+               for i in range(options['figures'])]
+    latencies = []
+    for _ in range(options['repeat']):
+        for figure in figures:
+            h, w = label_image.label_shape(figure)
+            _timed(lambda: label_image.synthesize_label(
+                figure, (2 * h, 2 * w)), latencies)
+    return latencies, 'labels'
+
+
+def suite_find_bad(options):
+    """Checks the JSON of the synthetic figures and of the paper."""
+    documents = [json.dumps(f) for f in corpus_figures()] + [
+        json.dumps(synthetic_figure(options['boxes'], seed=i))
+        for i in range(options['figures'])]
+    latencies = []
+    for _ in range(options['repeat']):
+        for document in documents:
+            _timed(lambda: find_bad.check(document), latencies)
+    return latencies, 'figures'
+
+
+def synthetic_prediction(label, seed=0):
+    """A prediction that is blurred, a bit shifted and noisy compared to
+    the label.
+    """
+    rng = np.random.RandomState(seed)
+    prediction = cv2.GaussianBlur(np.roll(label, 2, axis=1), (9, 9), 0)
+    noise = rng.normal(0, 20, label.shape)
+    return np.clip(prediction + noise, 0, 255).astype(np.uint8)
+
+
+def suite_calculate_diff(options):
+    """Compares predictions with the labels of the synthetic figures at
+    several thresholds in one worker process.
+    """
+    scratch = tempfile.mkdtemp()
+    list_file = os.path.join(scratch, 'list.txt')
+    latencies = []
+    try:
+        with open(list_file, 'w') as f:
+            for i in range(options['figures']):
+                label = label_image.gen_label(
+                    synthetic_figure(options['boxes'], seed=i))
+                name = 'figure-{}'.format(i)
+                cv2.imwrite(os.path.join(scratch, name + '-label.png'), label)
+                cv2.imwrite(os.path.join(scratch, name + '-predicted.png'),
+                            synthetic_prediction(label, seed=i))
+                f.write(name + '-predicted.png\n')
+
+        for _ in range(options['repeat']):
+            with _quiet():
+                _timed(lambda: rate.calculate_diff(
+                    list_file, THRESHOLDS, workers=1), latencies)
+    finally:
+        shutil.rmtree(scratch)
+    return latencies, 'images', options['figures']
+
+
+def suite_run_local(options, renderer_name):
+    """Renders the images and labels of the paper from the stored figures
+    (without pdffigures and without reusing earlier outputs).
+    """
+    # needs boto, which the other benchmarks do not
+    import label_gen
+
+    figures = corpus_figures()
+    renderer = render.get_renderer(renderer_name)
+    scratch = tempfile.mkdtemp()
+    latencies = []
+    try:
+        for _ in range(options['repeat']):
+            _timed(lambda: label_gen.run_local(
+                options['pdf'], scratch, False, False, renderer=renderer,
+                figures=list(figures), force=True), latencies)
+    finally:
+        renderer.close()
+        shutil.rmtree(scratch)
+    return latencies, 'figures', len(figures)
+
+
+def summarize(latencies, unit, items_per_run=1):
+    """Latency percentiles in ms and the throughput in items per second."""
+    latencies = np.array(latencies)
+    summary = OrderedDict([('unit', unit), ('runs', len(latencies))])
+    summary['latency_ms'] = OrderedDict(
+        ('p{}'.format(p), round(np.percentile(latencies, p) * 1000, 3))
+        for p in PERCENTILES)
+    summary['latency_ms']['mean'] = round(np.mean(latencies) * 1000, 3)
+    summary['latency_ms']['max'] = round(np.max(latencies) * 1000, 3)
+    summary['throughput'] = round(
+        len(latencies) * items_per_run / np.sum(latencies), 3)
+    return summary
+
+
+def _run_benchmark(name, options):
+    baseline = peak_rss()
+    benchmark, args = suite_benchmarks(options)[name]
+    result = benchmark(options, *args)
+    summary = summarize(*result)
+    summary['peak_rss_mb'] = round(peak_rss(), 1)
+    summary['baseline_rss_mb'] = round(baseline, 1)
+    return summary
+
+
+def suite_benchmarks(options):
+    """The benchmarks of the suite by name."""
+    benchmarks = OrderedDict()
+    for renderer in options['renderers']:
+        benchmarks['render_chart/{}'.format(renderer)] = (
+            suite_render_chart, (renderer,))
+    benchmarks['gen_labeled_image'] = (suite_labels, ())
+    benchmarks['synthesize_label'] = (suite_synthesize_label, ())
+    benchmarks['find_bad'] = (suite_find_bad, ())
+    benchmarks['calculate_diff'] = (suite_calculate_diff, ())
+    for renderer in options['renderers']:
+        benchmarks['run_local/{}'.format(renderer)] = (
+            suite_run_local, (renderer,))
+    return benchmarks
+
+
+def git_commit():
+    """The current commit (with -dirty if there are changes) or None."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty', '--abbrev=40'],
+                stderr=devnull).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(options, only=None, output=None):
+    commit = git_commit()
+    results = OrderedDict([
+        ('commit', commit),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('cpus', multiprocessing.cpu_count()),
+        ('options', options),
+        ('benchmarks', OrderedDict()),
+    ])
+
+    for name in suite_benchmarks(options):
+        if only and name.split('/')[0] not in only and name not in only:
+            continue
+        pool = multiprocessing.Pool(1)
+        try:
+            summary = pool.apply(_run_benchmark, (name, options))
+        except (ImportError, OSError) as e:
+            print("{}: not available ({})".format(name, e))
+            results['benchmarks'][name] = {'error': str(e)}
+            continue
+        except Exception as e:
+            # a broken stage should not hide the results of the others
+            print("{}: failed ({!r})".format(name, e))
+            results['benchmarks'][name] = {'error': repr(e)}
+            continue
+        finally:
+            pool.terminate()
+
+        results['benchmarks'][name] = summary
+        latency = summary['latency_ms']
+        print("{}: p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, "
+              "{:.1f} {}/s, peak RSS {:.1f} MB".format(
+                  name, latency['p50'], latency['p90'], latency['p99'],
+                  summary['throughput'], summary['unit'],
+                  summary['peak_rss_mb']))
+
+    output = output or 'benchmark-{}.json'.format((commit or 'unknown')[:12])
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Wrote {}".format(output))
+    return results
+
+
+def _change(old, new):
+    return 100.0 * (new - old) / old if old else 0.0
+
+
+def compare(baseline_file, results_file, tolerance):
+    """Prints the changes between two suite results. Returns the names of
+    the benchmarks that got slower (p50 latency or throughput) or need
+    more memory by more than tolerance percent.
+    """
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    with open(results_file) as f:
+        results = json.load(f)
+
+    print("{} -> {}".format(baseline.get('commit'), results.get('commit')))
+    regressions = []
+    for name, new in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if not old or 'error' in old or 'error' in new:
+            print("{}: not comparable".format(name))
+            continue
+
+        latency = _change(old['latency_ms']['p50'], new['latency_ms']['p50'])
+        throughput = _change(old['throughput'], new['throughput'])
+        memory = _change(old['peak_rss_mb'], new['peak_rss_mb'])
+        print("{}: p50 {:.1f} -> {:.1f} ms ({:+.1f}%), "
+              "{:.1f} -> {:.1f} {}/s ({:+.1f}%), "
+              "peak RSS {:.1f} -> {:.1f} MB ({:+.1f}%)".format(
+                  name, old['latency_ms']['p50'], new['latency_ms']['p50'],
+                  latency, old['throughput'], new['throughput'], new['unit'],
+                  throughput, old['peak_rss_mb'], new['peak_rss_mb'], memory))
+
+        if latency > tolerance or -throughput > tolerance or memory > tolerance:
+            regressions.append(name)
+
+    if regressions:
+        print("Regressions: {}".format(', '.join(regressions)))
+    return regressions
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+
+    if arguments['render']:
+        bench_render(arguments['FILE'] or 'testdata/paper.pdf',
+                     arguments['--renderer'],
+                     int(arguments['--dpi']), int(arguments['--repeat']))
+    elif arguments['labels']:
+        bench_labels(int(arguments['--boxes']), int(arguments['--figures']))
+    elif arguments['suite']:
+        only = None
+        if arguments['--only']:
+            only = arguments['--only'].split(',')
+        run_suite({
+            'pdf': arguments['FILE'] or 'testdata/paper.pdf',
+            'renderers': arguments['--renderer'],
+            'repeat': int(arguments['--repeat']),
+            'boxes': int(arguments['--boxes']),
+            'figures': int(arguments['--figures']),
+        }, only, arguments['--output'])
+    elif arguments['compare']:
+        if compare(arguments['BASELINE'], arguments['RESULTS'],
+                   float(arguments['--tolerance'])):
+            sys.exit(1)
@@ -3,3 +3,7 @@
 # s3 keys
 access_key = None
 secret_key = None
+
+# use a different S3 server, e.g. a local stand-in for testing
+# s3_host = 'localhost'
+# s3_port = 5000
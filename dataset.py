@@ -0,0 +1,566 @@
+"""Stream training samples (a figure image and its label) from the outputs
+of label_gen.
+
+The samples can come from
+  - a local directory that label_gen wrote (PATH or a flat directory),
+  - S3 (s3://BUCKET/PATH, the key layout of label_gen read-s3 and batch),
+  - shards (a local directory with .tar files or PATH/shards on S3, see
+    shards.py), which are read sequentially with few large reads.
+
+Labels are read from the label images (-label.png) or from label records in
+the boxes format (-labels.jsonl, see label_gen.py --label-format). Figures
+without a stored label (or all figures with --from-json) get a label that
+is computed from their JSON (see label_image.synthesize_label). On S3, this
+needs --from-json.
+
+The files are read by a pool of threads ahead of time. Several shards are
+read at once, so their samples are interleaved. A shuffle buffer mixes the
+encoded samples before they are decoded, cropped and resized by another
+pool of threads (OpenCV releases the GIL, so they use all cores).
+
+  for image, label in Dataset('out', shape=(256, 256), shuffle=1000):
+      ...
+
+The command reads a dataset and reports how many samples per second are
+read, e.g. to find out how many threads a machine needs.
+
+Usage:
+  dataset.py LOCATION [--factor=N] [--labels=FILE]... [--from-json] [--shape=HxW] [--resize] [--scale=RANGE] [--color] [--shuffle=N] [--seed=N] [--fetch-threads=N] [--decode-threads=N] [--limit=N] [--debug]
+  dataset.py (-h | --help)
+
+Options:
+  --factor=N            Resolution of the images in multiples of 100 DPI
+                        [default: 1].
+  --labels=FILE         Read labels from this file in the boxes format.
+  --from-json           Compute the labels from the JSON of the figures
+                        instead of reading stored labels.
+  --shape=HxW           Crop the samples to this size, e.g. 256x256.
+  --resize              Resize the samples to the shape instead of cropping.
+  --scale=RANGE         Scale the samples by a random factor in a range
+                        before cropping, e.g. 0.5,1.5.
+  --color               Read color images instead of grayscale.
+  --shuffle=N           Size of the shuffle buffer [default: 0].
+  --seed=N              Seed for the shuffle and the crops.
+  --fetch-threads=N     Number of threads that read files [default: 8].
+  --decode-threads=N    Number of threads that decode images (default:
+                        number of cores).
+  --limit=N             Stop after this many samples.
+  --debug               Write debug output.
+  -h --help             Show this screen.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
+
+import numpy as np
+import cv2
+from docopt import docopt
+
+import label_image
+import shards
+
+
+S3_SCHEME = 's3://'
+
+LABEL_SUFFIX = '-label.png'
+LABELS_SUFFIX = '-labels.jsonl'
+
+# padding of crops that are larger than the image
+WHITE = 255
+BLACK = 0
+
+# samples read or decoded ahead per thread
+AHEAD = 4
+
+
+def image_name(key, factor=1):
+    """Returns the file name of the image of a figure at a resolution."""
+    ext = '' if factor == 1 else '-{}x'.format(factor)
+    return '{}{}.png'.format(key, ext)
+
+
+def _is_image(name, factor):
+    return (shards.FIGURE.match(name) is not None and
+            image_name(shards.sample_key(name), factor) == name)
+
+
+def _document(key):
+    return key.rsplit('-Figure-', 1)[0]
+
+
+def _json_name(key):
+    return key + '.json'
+
+
+def _read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def parse_labels(data):
+    """Returns a dict from figure names to the label records in the
+    contents of a -labels.jsonl file.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    records = (json.loads(line) for line in data.splitlines() if line.strip())
+    return dict((r['name'], r) for r in records)
+
+
+def _bounded_map(executor, fn, items, ahead):
+    """Like executor.map, but items can be a lazy (or endless) iterator. At
+    most ahead items are submitted that have not been consumed.
+    """
+    pending = collections.deque()
+    try:
+        for item in items:
+            if len(pending) >= ahead:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, item))
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def local_samples(directory, factor=1, labels=None, threads=8,
+                  from_json=False):
+    """Reads the samples in a directory that label_gen wrote (with json,
+    img and text-masked subdirectories or flat). Yields the name of every
+    figure, the data of its image and its label (the data of the label
+    image, a label record or the description of the figure).
+    """
+
+    img_dir = os.path.join(directory, 'img')
+    label_dir = os.path.join(directory, 'text-masked')
+    json_dir = os.path.join(directory, 'json')
+    if not os.path.isdir(img_dir):
+        img_dir = label_dir = json_dir = directory
+
+    labels = dict(labels or {})
+    for name in sorted(os.listdir(label_dir)):
+        if name.endswith(LABELS_SUFFIX):
+            labels.update(label_image.read_labels(
+                os.path.join(label_dir, name)))
+
+    names = sorted(n for n in os.listdir(img_dir) if _is_image(n, factor))
+
+    def read(name):
+        key = shards.sample_key(name)
+        label = None if from_json else labels.get(key)
+        label_file = os.path.join(label_dir, key + LABEL_SUFFIX)
+        try:
+            image = _read_file(os.path.join(img_dir, name))
+            if label is None and not from_json and os.path.exists(label_file):
+                label = _read_file(label_file)
+            if label is None:
+                label = json.loads(_read_file(
+                    os.path.join(json_dir, _json_name(key))).decode('utf-8'))
+        except IOError as e:
+            logging.debug('Skip {}: {}'.format(key, e))
+            return None
+        return key, image, label
+
+    executor = ThreadPoolExecutor(threads)
+    try:
+        for sample in _bounded_map(executor, read, names, AHEAD * threads):
+            if sample is not None:
+                yield sample
+    finally:
+        executor.shutdown(wait=False)
+
+
+def s3_samples(bucket_name, path, factor=1, labels=None, threads=16,
+               from_json=False):
+    """Reads the samples under a path in an S3 bucket, like local_samples.
+    Labels in the boxes format have to be passed in (see
+    label_image.read_labels). With from_json, the JSON of the figures is
+    read instead of the labels.
+    """
+
+    # only needed for S3, needs boto and config.py
+    import s3util
+
+    labels = {} if from_json else labels or {}
+    bucket = s3util.get_bucket(bucket_name)
+
+    # the figures whose keys were requested, in order
+    planned = collections.deque()
+
+    def key_names():
+        for key in bucket.list(os.path.join(path, 'img', '')):
+            name = os.path.basename(key.name)
+            if not _is_image(name, factor):
+                continue
+            sample = shards.sample_key(name)
+            planned.append(sample)
+            yield key.name
+            if from_json:
+                yield os.path.join(path, 'json', _json_name(sample))
+            elif sample not in labels:
+                yield os.path.join(path, 'text-masked', sample + LABEL_SUFFIX)
+
+    results = s3util.read_keys(bucket_name, key_names(), threads)
+    for name, image, error in results:
+        key = planned.popleft()
+        label = labels.get(key)
+        if label is None:
+            _, label, label_error = next(results)
+            error = error or label_error
+        if error:
+            logging.debug('Skip {}: {}'.format(key, error))
+            continue
+        if from_json:
+            label = json.loads(label.decode('utf-8'))
+        yield key, image, label
+
+
+def _labeled(waiting, records):
+    """Yields the waiting figures with their label record or, if there is
+    none, their description.
+    """
+    for figure, image, description in waiting:
+        if figure in records:
+            yield figure, image, records[figure]
+        elif description is not None:
+            yield figure, image, json.loads(description.decode('utf-8'))
+        else:
+            logging.debug('Skip {}: no label'.format(figure))
+
+
+def shard_samples(fileobj, factor=1, labels=None, from_json=False):
+    """Reads the samples of a shard sequentially, like local_samples."""
+
+    labels = labels or {}
+
+    # figures whose labels are in the -labels.jsonl file of their document,
+    # which is stored after the figures
+    waiting = []
+
+    for key, files in shards.iter_samples(fileobj):
+        labels_file = key + '.jsonl'
+        if labels_file.endswith(LABELS_SUFFIX) and labels_file in files:
+            records = {} if from_json else parse_labels(files[labels_file])
+            for sample in _labeled(waiting, records):
+                yield sample
+            waiting = []
+            continue
+
+        image = files.get(image_name(key, factor))
+        if image is None:
+            continue
+
+        if waiting and _document(waiting[0][0]) != _document(key):
+            for sample in _labeled(waiting, {}):
+                yield sample
+            waiting = []
+
+        description = files.get(_json_name(key))
+        label = None
+        if not from_json:
+            label = files.get(key + LABEL_SUFFIX) or labels.get(key)
+        if label is None:
+            waiting.append((key, image, description))
+        else:
+            yield key, image, label
+
+    for sample in _labeled(waiting, {}):
+        yield sample
+
+
+def interleave(open_shard, names, threads, factor=1, labels=None,
+               from_json=False):
+    """Reads several shards at once with a thread per shard and yields
+    their samples as they arrive.
+    """
+
+    names = iter(names)
+    lock = threading.Lock()
+    samples = queue.Queue(AHEAD * threads)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                samples.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read():
+        while not stop.is_set():
+            with lock:
+                name = next(names, None)
+            if name is None:
+                break
+            try:
+                fileobj = open_shard(name)
+                try:
+                    for sample in shard_samples(fileobj, factor, labels,
+                                                from_json):
+                        put(sample)
+                        if stop.is_set():
+                            break
+                finally:
+                    fileobj.close()
+            except Exception as e:
+                logging.warning('Could not read shard {}: {}'.format(name, e))
+        put(done)
+
+    readers = [threading.Thread(target=read) for _ in range(threads)]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    try:
+        running = len(readers)
+        while running:
+            sample = samples.get()
+            if sample is done:
+                running -= 1
+            else:
+                yield sample
+    finally:
+        stop.set()
+
+
+def open_source(location, factor=1, labels=None, threads=8,
+                from_json=False):
+    """Returns the samples (see local_samples) of a local directory or an
+    S3 path (s3://BUCKET/PATH), from shards if there are any.
+    """
+
+    if location.startswith(S3_SCHEME):
+        bucket_name, _, path = location[len(S3_SCHEME):].partition('/')
+        path = path.rstrip('/')
+
+        import s3util
+        from boto.s3.key import Key
+
+        shard_names = sorted(
+            key.name for key in s3util.get_bucket(bucket_name).list(
+                os.path.join(path, 'shards', '')) if key.name.endswith('.tar'))
+        if not shard_names:
+            return s3_samples(bucket_name, path, factor, labels, threads,
+                              from_json)
+
+        def open_shard(name):
+            return Key(s3util.get_bucket(bucket_name), name)
+        return interleave(open_shard, shard_names, threads, factor, labels,
+                          from_json)
+
+    directory = location
+    if os.path.isdir(os.path.join(location, 'shards')):
+        directory = os.path.join(location, 'shards')
+    shard_names = sorted(os.path.join(directory, n)
+                         for n in os.listdir(directory) if n.endswith('.tar'))
+    if not shard_names:
+        return local_samples(location, factor, labels, threads, from_json)
+
+    def open_shard(name):
+        return open(name, 'rb')
+    return interleave(open_shard, shard_names, threads, factor, labels,
+                      from_json)
+
+
+def shuffled(items, size, rng):
+    """Shuffles items in a buffer of the given size."""
+    buf = []
+    for item in items:
+        if len(buf) < size:
+            buf.append(item)
+            continue
+        i = rng.randrange(size)
+        yield buf[i]
+        buf[i] = item
+
+    rng.shuffle(buf)
+    for item in buf:
+        yield item
+
+
+def _resize(image, size, interpolation):
+    if image.shape[:2] == size:
+        return image
+    return cv2.resize(image, (size[1], size[0]), interpolation=interpolation)
+
+
+def _crop(image, shape, top, left, fill):
+    """Crops shape at top, left. The image is padded with fill where the
+    crop is outside of it.
+    """
+    h, w = shape
+    bottom = max(0, top + h - image.shape[0])
+    right = max(0, left + w - image.shape[1])
+    if bottom or right:
+        image = cv2.copyMakeBorder(image, 0, bottom, 0, right,
+                                   cv2.BORDER_CONSTANT, value=fill)
+    return image[top:top + h, left:left + w]
+
+
+def decode(sample, shape=None, resize=False, scale=None, color=False,
+           seed=None):
+    """Decodes the image and the label (black and white at the size of the
+    image) of a sample. Returns None if the image cannot be decoded.
+
+    If shape (height, width) is set, the sample is resized to it or a
+    random part of it is cropped (padded with white if the image is
+    smaller). With scale (a range), the sample is first scaled by a random
+    factor.
+    """
+
+    name, image, label = sample
+    rng = random.Random(seed)
+
+    flags = cv2.CV_LOAD_IMAGE_COLOR if color else cv2.CV_LOAD_IMAGE_GRAYSCALE
+    image = cv2.imdecode(np.frombuffer(image, np.uint8), flags)
+    if image is None:
+        logging.warning('Could not decode the image of {}'.format(name))
+        return None
+
+    size = image.shape[:2]
+    if scale:
+        factor = rng.uniform(*scale)
+        size = (max(1, int(round(size[0] * factor))),
+                max(1, int(round(size[1] * factor))))
+    if shape and resize:
+        size = tuple(shape)
+    image = _resize(image, size, cv2.INTER_AREA)
+
+    if isinstance(label, dict) and 'ImageText' in label:
+        # the description of the figure
+        label = label_image.synthesize_label(label, size)
+    elif isinstance(label, dict):
+        label = label_image.decode_label(label, size)
+    else:
+        label = cv2.imdecode(np.frombuffer(label, np.uint8),
+                             cv2.CV_LOAD_IMAGE_GRAYSCALE)
+        label = _resize(label, size, cv2.INTER_NEAREST)
+
+    if shape and not resize:
+        top = rng.randint(0, max(0, size[0] - shape[0]))
+        left = rng.randint(0, max(0, size[1] - shape[1]))
+        image = _crop(image, shape, top, left, WHITE)
+        label = _crop(label, shape, top, left, BLACK)
+
+    return image, label
+
+
+class Dataset(object):
+    """Iterates over the (image, label) pairs of the outputs of label_gen
+    at a location (see open_source). Every iteration reads all samples
+    again, shuffled differently if shuffle is set.
+
+    The keyword arguments shape, resize, scale and color are passed to
+    decode.
+    """
+
+    def __init__(self, location, factor=1, labels=None, shuffle=0, seed=None,
+                 fetch_threads=8, decode_threads=None, from_json=False,
+                 **options):
+        self.location = location
+        self.factor = factor
+        self.labels = labels
+        self.from_json = from_json
+        self.shuffle = shuffle
+        self.seed = seed
+        self.fetch_threads = fetch_threads
+        self.decode_threads = decode_threads or multiprocessing.cpu_count()
+        self.options = options
+        self.epoch = 0
+
+    def __iter__(self):
+        seed = self.seed
+        if seed is not None:
+            seed += self.epoch
+        self.epoch += 1
+        rng = random.Random(seed)
+
+        samples = open_source(self.location, self.factor, self.labels,
+                              self.fetch_threads, self.from_json)
+        if self.shuffle:
+            samples = shuffled(samples, self.shuffle, rng)
+
+        # every sample gets its own seed, so that the crops do not depend
+        # on the order in which the threads decode them
+        seeded = ((sample, rng.getrandbits(32)) for sample in samples)
+
+        def decode_sample(item):
+            sample, sample_seed = item
+            return decode(sample, seed=sample_seed, **self.options)
+
+        executor = ThreadPoolExecutor(self.decode_threads)
+        try:
+            for pair in _bounded_map(executor, decode_sample, seeded,
+                                     AHEAD * self.decode_threads):
+                if pair is not None:
+                    yield pair
+        finally:
+            executor.shutdown(wait=False)
+
+
+def parse_shape(shape):
+    """Parses HxW, e.g. 256x256."""
+    h, w = shape.lower().split('x')
+    return int(h), int(w)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+
+    if arguments['--debug']:
+        logging.basicConfig(level=logging.DEBUG)
+
+    labels = {}
+    for labels_file in arguments['--labels']:
+        labels.update(label_image.read_labels(labels_file))
+
+    options = {'resize': arguments['--resize'], 'color': arguments['--color']}
+    if arguments['--shape']:
+        options['shape'] = parse_shape(arguments['--shape'])
+    if arguments['--scale']:
+        options['scale'] = [float(s) for s in arguments['--scale'].split(',')]
+
+    dataset = Dataset(
+        arguments['LOCATION'], int(arguments['--factor']), labels,
+        int(arguments['--shuffle']),
+        int(arguments['--seed']) if arguments['--seed'] else None,
+        int(arguments['--fetch-threads']),
+        int(arguments['--decode-threads'] or 0), arguments['--from-json'],
+        **options)
+    limit = int(arguments['--limit'] or 0)
+
+    start = time.time()
+    count = 0
+    pixels = 0
+    for image, label in dataset:
+        count += 1
+        pixels += image.shape[0] * image.shape[1]
+        if count % 100 == 0:
+            sys.stderr.write("Read {} samples, {:.1f} samples/s\r".format(
+                count, count / (time.time() - start)))
+        if count == limit:
+            break
+    sys.stderr.write("\n")
+
+    elapsed = time.time() - start
+    print("Read {} samples ({:.1f} megapixels) in {:.1f} s, "
+          "{:.1f} samples/s".format(count, pixels / 1e6, elapsed,
+                                    count / elapsed if elapsed else 0))
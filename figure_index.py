@@ -0,0 +1,264 @@
+"""Index of the figures in SQLite
+
+Reads the JSON files that label_gen.py writes for every figure and stores
+one row per figure in a SQLite database, so that questions about the corpus
+do not require reading all JSON files again. Every figure has the columns
+
+  id          name of the figure, e.g. C08-1099-Figure-3
+  paper       name of the paper
+  type        Figure or Table
+  number      number of the figure in the paper
+  page        page of the figure
+  x0, y0, x1, y1
+              bounds of the figure on the page (100 DPI)
+  width, height
+              size of the figure at 100 DPI
+  boxes       number of text boxes
+  text_ratio  area of the text boxes as a fraction of the area of the figure
+  rotation_0, rotation_90, rotation_180, rotation_270
+              number of text boxes with each rotation
+  bad         why find_bad.py considers the figure bad or NULL
+  json, image, label
+              paths or S3 URLs of the JSON, the 1x image and the label
+
+Ingesting is incremental: files that are already in the index and have not
+changed (same size and modification time or S3 ETag) are skipped, so the
+commands can be run again when new papers have been processed.
+
+Usage:
+  figure_index.py ingest DB PATH... [--debug]
+  figure_index.py ingest-s3 DB S3-BUCKET S3-PATH [--threads=N] [--debug]
+  figure_index.py query DB [WHERE] [--columns=COLUMNS] [--limit=N]
+  figure_index.py (-h | --help)
+
+Examples:
+  figure_index.py query index.db "boxes > 20 AND page = 1"
+  figure_index.py query index.db "bad IS NULL" --columns=image,label
+
+Options:
+  --threads=N          Number of concurrent requests [default: 16].
+  --columns=COLUMNS    Comma separated columns to print [default: id].
+  --limit=N            Print at most N rows.
+  --debug              Write debug output.
+  -h --help            Show this screen.
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+
+import numpy as np
+from docopt import docopt
+
+import find_bad
+
+
+# number of figures per transaction
+BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS figures (
+    id TEXT PRIMARY KEY,
+    paper TEXT,
+    type TEXT,
+    number INTEGER,
+    page INTEGER,
+    x0 REAL, y0 REAL, x1 REAL, y1 REAL,
+    width REAL, height REAL,
+    boxes INTEGER,
+    text_ratio REAL,
+    rotation_0 INTEGER, rotation_90 INTEGER,
+    rotation_180 INTEGER, rotation_270 INTEGER,
+    bad TEXT,
+    json TEXT, image TEXT, label TEXT
+);
+CREATE INDEX IF NOT EXISTS figures_paper ON figures (paper);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    stamp TEXT
+);
+"""
+
+COLUMNS = ['id', 'paper', 'type', 'number', 'page', 'x0', 'y0', 'x1', 'y1',
+           'width', 'height', 'boxes', 'text_ratio', 'rotation_0',
+           'rotation_90', 'rotation_180', 'rotation_270', 'bad',
+           'json', 'image', 'label']
+
+
+def connect(db_file):
+    conn = sqlite3.connect(db_file)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def output_paths(json_path, name):
+    """Returns the paths of the image and the label of the figure, in the
+    nested or flat layout of label_gen.py.
+    """
+    json_dir = os.path.dirname(json_path)
+    if os.path.basename(json_dir) != 'json':
+        # flat: all files in one directory
+        return (os.path.join(json_dir, name + '.png'),
+                os.path.join(json_dir, name + '-label.png'))
+    root = os.path.dirname(json_dir)
+    return (os.path.join(root, 'img', name + '.png'),
+            os.path.join(root, 'text-masked', name + '-label.png'))
+
+
+def figure_rows(figures, paths):
+    """Computes the rows for the figures (parsed JSON) that were read from
+    the paths.
+    """
+
+    boxes, index, bounds = find_bad.text_array(figures)
+    n = len(figures)
+
+    counts = np.bincount(index, minlength=n)
+    text_area = np.bincount(index, weights=find_bad.area(boxes), minlength=n)
+    figure_area = find_bad.area(bounds)
+    ratios = text_area / np.where(figure_area > 0, figure_area, 1)
+
+    # rotations are in quarter turns
+    rotations = np.array([text.get('Rotation', 0) % 4 for data in figures
+                          for text in data['ImageText']], int)
+    histogram = np.zeros((n, 4), int)
+    np.add.at(histogram, (index, rotations), 1)
+
+    reasons = find_bad.bad_reasons(figures)
+
+    rows = []
+    for i, (data, path) in enumerate(zip(figures, paths)):
+        name = find_bad.figure_name(path)
+        image, label = output_paths(path, name)
+        x0, y0, x1, y1 = bounds[i]
+        rows.append((
+            name, name.rsplit('-Figure-', 1)[0],
+            data.get('Type'), data.get('Number'), data['Page'],
+            x0, y0, x1, y1, x1 - x0, y1 - y0,
+            int(counts[i]), float(ratios[i])) +
+            tuple(int(c) for c in histogram[i]) +
+            (data.get('Bad') or reasons[i], path, image, label))
+    return rows
+
+
+def ingest(conn, items):
+    """Adds the figures from (path, stamp, JSON data) triples to the index,
+    replacing older rows of the same figures.
+    """
+
+    batch = []
+    count = 0
+
+    def flush():
+        rows = figure_rows([json.loads(data) for _, _, data in batch],
+                           [path for path, _, _ in batch])
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO figures VALUES ({})'.format(
+                ', '.join('?' * len(COLUMNS))), rows)
+            conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?)',
+                             [(path, stamp) for path, stamp, _ in batch])
+
+    start = time.time()
+    for path, stamp, data in items:
+        batch.append((path, stamp, data))
+        if len(batch) == BATCH_SIZE:
+            flush()
+            count += len(batch)
+            batch = []
+            sys.stderr.write('Indexed {} figures, {:.1f} figures/s\n'.format(
+                count, count / (time.time() - start)))
+    if batch:
+        flush()
+        count += len(batch)
+
+    sys.stderr.write('Indexed {} new or changed figures in {:.1f}s\n'.format(
+        count, time.time() - start))
+
+
+def known_files(conn):
+    return dict(conn.execute('SELECT path, stamp FROM files'))
+
+
+def local_items(conn, paths):
+    """Yields the JSON files in the directories (or glob patterns) that are
+    new or have changed since they were indexed.
+    """
+    known = known_files(conn)
+    for json_file in find_bad.json_files(paths):
+        if not find_bad.figure_name(json_file):
+            continue
+        st = os.stat(json_file)
+        stamp = '{}-{}'.format(st.st_size, st.st_mtime)
+        if known.get(json_file) == stamp:
+            continue
+        with open(json_file) as f:
+            yield json_file, stamp, f.read()
+
+
+def s3_items(conn, bucket_name, path, threads=16):
+    """Yields the JSON files under path in the bucket that are new or have
+    changed since they were indexed.
+    """
+    import s3util
+
+    known = known_files(conn)
+    stamps = {}
+    for key in s3util.get_bucket(bucket_name).list(path):
+        url = 's3://{}/{}'.format(bucket_name, key.name)
+        if key.name.endswith('.json') and find_bad.figure_name(key.name):
+            if known.get(url) != key.etag:
+                stamps[key.name] = key.etag
+    logging.debug('{} new or changed files'.format(len(stamps)))
+
+    for name, data, error in s3util.read_keys(bucket_name, sorted(stamps),
+                                              threads):
+        if error:
+            logging.error('Could not read {}: {}'.format(name, error))
+            continue
+        yield 's3://{}/{}'.format(bucket_name, name), stamps[name], data
+
+
+def query(conn, where=None, columns=('id',), limit=None):
+    """Yields the rows of the figures that match the SQL condition."""
+    for column in columns:
+        if column not in COLUMNS:
+            raise ValueError('Unknown column {}. Use one of {}.'.format(
+                column, ', '.join(COLUMNS)))
+
+    sql = 'SELECT {} FROM figures'.format(', '.join(columns))
+    if where:
+        sql += ' WHERE ' + where
+    sql += ' ORDER BY id'
+    if limit is not None:
+        sql += ' LIMIT {:d}'.format(limit)
+    return conn.execute(sql)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+
+    if arguments['--debug']:
+        logging.basicConfig(level=logging.DEBUG)
+        logging.getLogger("boto").setLevel(logging.WARNING)
+
+    conn = connect(arguments['DB'])
+
+    if arguments['ingest']:
+        ingest(conn, local_items(conn, arguments['PATH']))
+    elif arguments['ingest-s3']:
+        ingest(conn, s3_items(conn, arguments['S3-BUCKET'],
+                              arguments['S3-PATH'],
+                              int(arguments['--threads'])))
+    elif arguments['query']:
+        limit = arguments['--limit']
+        try:
+            rows = query(conn, arguments['WHERE'],
+                         arguments['--columns'].split(','),
+                         int(limit) if limit else None)
+        except (ValueError, sqlite3.Error) as e:
+            sys.exit(str(e))
+        for row in rows:
+            print('\t'.join('' if v is None else str(v) for v in row))
@@ -8,20 +8,46 @@ those even if they have a little bit of text in  them from for example a
 caption or some other text in the document.
 
 Criteria for exclusion:
- - no or very few labels
- - only text close to the border
- - almost all of the picture is white
+ - no or very few labels (--min-boxes)
+ - only text close to the border (--border)
+ - almost all of the picture is text (--text-ratio)
+
+To run many instances of read-s3 in parallel, every instance (--chunk) only
+lists the keys in its own range of the key space. The ranges command lists
+the keys once and prints boundaries that split them into --of parts of the
+same size; pass the output with --ranges. Without --ranges, the key space is
+split evenly by the first character after S3-PATH, which can be unbalanced.
+Alternatively, --manifest takes a file with one key per line (e.g. from an
+S3 inventory) and every instance reads its slice of it without listing.
+
+The read command checks the JSON files in one or more local directories
+(or glob patterns such as 'data/*/json') with a pool of worker processes.
+The bad figures are printed in the order of the files.
 
 Usage:
-  find_bad.py read-s3 S3-BUCKET S3-PATH [--chunk=CHUNK] [--of=OF] [--debug]
-  find_bad.py read PATH [--debug]
-  find_bad.py check FILE [--debug]
+  find_bad.py read-s3 S3-BUCKET S3-PATH [--chunk=CHUNK] [--of=OF] [--ranges=FILE | --manifest=FILE] [--threads=N] [--min-boxes=N] [--border=FRACTION] [--text-ratio=RATIO] [--reasons] [--debug]
+  find_bad.py ranges S3-BUCKET S3-PATH [--of=OF] [--debug]
+  find_bad.py read PATH... [--workers=N] [--chunk-size=N] [--min-boxes=N] [--border=FRACTION] [--text-ratio=RATIO] [--reasons] [--debug]
+  find_bad.py check FILE [--min-boxes=N] [--border=FRACTION] [--text-ratio=RATIO] [--debug]
   find_bad.py (-h | --help)
   find_bad.py --version
 
 Options:
   --chunk=CHUNK   Which part [default: 0]
   --of=OF         Of how many [default: 1]
+  --ranges=FILE   Boundaries of the key ranges from the ranges command.
+  --manifest=FILE File with all keys to check, one per line.
+  --threads=N     Number of concurrent requests [default: 16].
+  --workers=N     Number of worker processes (default: number of cores).
+  --chunk-size=N  Number of files to send to a worker at once [default: 256].
+  --min-boxes=N   Minimum number of text boxes [default: 2].
+  --border=FRACTION
+                  Height of the upper and lower border as a fraction of the
+                  height of the figure [default: 0.05].
+  --text-ratio=RATIO
+                  Maximum area of the text boxes as a fraction of the area
+                  of the figure [default: 0.5].
+  --reasons       Print why a figure is bad after its name.
   --debug         Write debug output.
   -h --help       Show this screen.
   --version       Show version.
@@ -29,131 +55,299 @@ Options:
 
 import os
 import re
+import glob
+import string
+import multiprocessing
 import logging
 import json
 import sys
 import time
+import functools
+import itertools
 
+import numpy as np
 from docopt import docopt
-from boto.s3.connection import S3Connection
 
-import config
+try:
+    from os import scandir
+except ImportError:
+    # python < 3.5
+    from scandir import scandir
 
-PATTERN = re.compile('(.*-Figure-[0-9]+).*\.json')
-
-
-# true if a is in b
-def contains(a, b):
-    return (a[0] > b[0] and a[2] < b[2] and
-            a[1] > b[1] and a[3] < b[3])
-
-
-def area(a):
-    return (a[2] - a[0]) * (a[3] - a[1])
-
-
-def all_in_border(bounds, texts):
-    """ Returns true if all text is either in upper or lower border area. """
-    x0, y0, x1, y1 = bounds
-    h = y1 - y0
-
-    not_top_border = [x0, y0 + h*0.05,
-                      x1, y1]
-    not_bottom_border = [x0, y0,
-                         x1, y1 - h*0.05]
-
-    top = False
-    bottom = False
-
-    for text in texts:
-        if contains(text['TextBB'], not_top_border):
-            top = True
-
-        if contains(text['TextBB'], not_bottom_border):
-            bottom = True
-
-        if top and bottom:
-            return False
-
-    return True
+import s3util
 
+PATTERN = re.compile('(.*-Figure-[0-9]+).*\.json')
 
-def is_sum_larger(max_area, texts):
-    sum_so_far = 0
-    for text in texts:
-        sum_so_far += area(text['TextBB'])
-        if sum_so_far > max_area:
-            return True
-    return False
+# characters that file names start with, in sorted order
+KEY_CHARACTERS = string.digits + string.ascii_uppercase + string.ascii_lowercase
 
 
-def check(json_data):
-    data = json.loads(json_data)
-    texts = data['ImageText']
+# default criteria, see check_many
+MIN_BOXES = 2
+BORDER = 0.05
+TEXT_RATIO = 0.5
 
-    # no text at all
-    if len(texts) == 0:
-        logging.debug("No text")
-        return True
+# in the order in which they are reported
+REASONS = ['no text', 'few text labels', 'text in border', 'mostly text']
 
-    # very little text
-    if len(texts) == 1:
-        logging.debug("One text label")
-        return True
 
-    # all the text is within the border area (probably an artifact)
-    if all_in_border(data['ImageBB'], texts):
-        logging.debug("All text is in upper or lower border")
-        return True
+def area(a):
+    return (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+
+
+def text_array(figures):
+    """Parses the boxes of many figures once. Returns an (N, 4) array of
+    all text boxes, the index of the figure of every box and an (F, 4)
+    array of the bounds of the figures.
+    """
+    boxes = [text['TextBB'] for data in figures for text in data['ImageText']]
+    counts = [len(data['ImageText']) for data in figures]
+    bounds = [data['ImageBB'] for data in figures]
+
+    # much faster than np.array for nested lists
+    boxes = np.fromiter(itertools.chain.from_iterable(boxes), float,
+                        4 * len(boxes)).reshape(-1, 4)
+    bounds = np.fromiter(itertools.chain.from_iterable(bounds), float,
+                         4 * len(bounds)).reshape(-1, 4)
+    index = np.repeat(np.arange(len(figures)), counts)
+    return boxes, index, bounds
+
+
+def check_many(figures, min_boxes=MIN_BOXES, border=BORDER,
+               text_ratio=TEXT_RATIO):
+    """Checks many figures (the parsed JSON) at once.
+
+    Returns a dict from every reason in REASONS to a boolean array that is
+    true for the figures that fail the criterion:
+     - no text: no text boxes
+     - few text labels: fewer than min_boxes text boxes
+     - text in border: no text box is outside of the upper or lower border
+       (border times the height of the figure); probably an artifact
+     - mostly text: the text boxes sum up to more than text_ratio of the
+       area of the figure
+    """
+    return check_arrays(*text_array(figures), min_boxes=min_boxes,
+                        border=border, text_ratio=text_ratio)
+
+
+def check_arrays(boxes, index, bounds, min_boxes=MIN_BOXES, border=BORDER,
+                 text_ratio=TEXT_RATIO):
+    """Like check_many for the arrays from text_array. Parse the figures
+    once and call this to try many criteria.
+    """
+
+    n = len(bounds)
+    counts = np.bincount(index, minlength=n)
+
+    # the bounds of the figure of every box
+    b = bounds[index]
+    margin = (b[:, 3] - b[:, 1]) * border
+    inside = ((boxes[:, 0] > b[:, 0]) & (boxes[:, 2] < b[:, 2]) &
+              (boxes[:, 1] > b[:, 1]) & (boxes[:, 3] < b[:, 3]))
+    below_top = inside & (boxes[:, 1] > b[:, 1] + margin)
+    above_bottom = inside & (boxes[:, 3] < b[:, 3] - margin)
 
-    # almost the whole image is text
     # use crude implementation where we just sum up the text area
-    # and kick something out if >50% is text
-    a = area(data['ImageBB'])
-    if is_sum_larger(a*0.5, texts):
-        logging.debug("Almost everything is text")
-        return True
-
-    return False
-
-
-def run_s3(bucket_name, path, chunk, of):
-    conn = S3Connection(config.access_key, config.secret_key, is_secure=False)
-    bucket = conn.get_bucket(bucket_name)
-
-    print >> sys.stderr, "Run {} of {}".format(chunk, of)
-
-    start = time.time()
-
-    for i, key in enumerate(bucket.list(path)):
-        if i % 1000 == 0:
-            so_far = time.time() - start
-            logging.info("Processing number {} after {} seconds".format(i, so_far))
-
-        if i % of == chunk:
-            if key.name.strip('/') == path.strip('/'):
+    text_area = np.bincount(index, weights=area(boxes), minlength=n)
+
+    return {
+        'no text': counts == 0,
+        'few text labels': counts < min_boxes,
+        'text in border': ~((np.bincount(index, below_top, n) > 0) &
+                            (np.bincount(index, above_bottom, n) > 0)),
+        'mostly text': text_area > area(bounds) * text_ratio,
+    }
+
+
+def bad_reasons(figures, **criteria):
+    """Returns the first reason why each figure is bad or None if it is
+    good. The criteria are passed to check_many.
+    """
+    failed = check_many(figures, **criteria)
+    reasons = np.full(len(figures), None, object)
+    for reason in reversed(REASONS):
+        reasons[failed[reason]] = reason
+    return list(reasons)
+
+
+def bad_reason(data, **criteria):
+    """Returns why the figure described by data (the parsed JSON) is
+    probably not a good label or None if it is good.
+    """
+    reason = bad_reasons([data], **criteria)[0]
+    if reason:
+        logging.debug("Bad figure: {}".format(reason))
+    return reason
+
+
+def check(json_data, **criteria):
+    return bad_reason(json.loads(json_data), **criteria) is not None
+
+
+def prefix_ranges(path, of):
+    """Splits the keys under path into of ranges by their first character.
+    Returns the of - 1 boundaries between the ranges.
+    """
+    if not path.endswith('/'):
+        path += '/'
+    n = len(KEY_CHARACTERS)
+    return [path + KEY_CHARACTERS[i * n // of] for i in range(1, of)]
+
+
+def key_ranges(bucket_name, path, of):
+    """Lists the keys under path once and returns the of - 1 boundaries
+    that split them into parts of (almost) the same size.
+    """
+    names = [key.name for key in s3util.get_bucket(bucket_name).list(path)]
+    if not names:
+        return [path] * (of - 1)
+    return [names[max(i * len(names) // of, 1) - 1] for i in range(1, of)]
+
+
+def list_range(bucket_name, path, lower, upper):
+    """Yields the names of the keys under path that are larger than lower
+    and at most upper (None for no bound). The listing starts at lower.
+    """
+    bucket = s3util.get_bucket(bucket_name)
+    for key in bucket.list(path, marker=lower or ''):
+        if upper is not None and key.name > upper:
+            return
+        yield key.name
+
+
+def read_lines(filename):
+    with open(filename) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def figure_name(filename):
+    groups = PATTERN.search(os.path.basename(filename))
+    if groups:
+        return groups.group(1)
+    return None
+
+
+def print_bad(name, reason, reasons=False):
+    if reasons:
+        print('{}\t{}'.format(name, reason))
+    else:
+        print(name)
+
+
+def run_s3(bucket_name, path, chunk, of, ranges=None, manifest=None,
+           threads=16, reasons=False, **criteria):
+    sys.stderr.write("Run {} of {}\n".format(chunk, of))
+
+    if manifest is not None:
+        names = manifest[chunk * len(manifest) // of:
+                         (chunk + 1) * len(manifest) // of]
+    else:
+        if ranges is None:
+            ranges = prefix_ranges(path, of)
+        # chunk i covers (ranges[i - 1], ranges[i]]
+        bounds = [None] + list(ranges) + [None]
+        names = list_range(bucket_name, path, bounds[chunk], bounds[chunk + 1])
+
+    def json_keys():
+        for name in names:
+            if name.strip('/') == path.strip('/'):
                 # ignore the directory itself
                 continue
-            if os.path.splitext(key.name)[1] == '.json':
-                if check(key.get_contents_as_string()):
-                    groups = PATTERN.search(os.path.basename(key.name))
-                    if groups:
-                        print(groups.group(1))
+            if os.path.splitext(name)[1] == '.json':
+                yield name
             else:
-                logging.error("Not a json file {}".format(key.name))
+                logging.error("Not a json file {}".format(name))
 
+    start = time.time()
+    count = 0
+    failed = 0
 
-def run_local(path):
-    for name in os.listdir(path):
-        json_file = os.path.join(path, name)
-        if os.path.isfile(json_file):
-            if os.path.splitext(name)[1] == '.json':
+    for name, data, error in s3util.read_keys(bucket_name, json_keys(),
+                                              threads):
+        count += 1
+        if count % 1000 == 0:
+            so_far = time.time() - start
+            sys.stderr.write("Checked {} keys in {:.1f}s, {:.1f} keys/s\n".format(
+                count, so_far, count / so_far))
+
+        if error:
+            logging.error("Could not read {}: {}".format(name, error))
+            failed += 1
+            continue
+
+        reason = bad_reason(json.loads(data), **criteria)
+        if reason and figure_name(name):
+            print_bad(figure_name(name), reason, reasons)
+
+    so_far = time.time() - start
+    sys.stderr.write("Checked {} keys ({} failed) in {:.1f}s, {:.1f} keys/s\n".format(
+        count, failed, so_far, count / max(so_far, 1e-9)))
+
+
+def json_files(paths):
+    """Yields the JSON files in the directories (or glob patterns) in
+    sorted order, without a stat call per file on most file systems.
+    """
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            entries = sorted(scandir(path), key=lambda e: e.name)
+            for entry in entries:
+                if entry.name.endswith('.json') and entry.is_file():
+                    yield entry.path
+
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def check_files(json_files, **criteria):
+    """Checks the JSON files together. Returns the number of files and the
+    names of the bad figures with the reasons.
+    """
+    figures = []
+    for json_file in json_files:
+        with open(json_file) as f:
+            figures.append(json.load(f))
+
+    bad = []
+    for json_file, reason in zip(json_files, bad_reasons(figures, **criteria)):
+        if reason and figure_name(json_file):
+            bad.append((figure_name(json_file), reason))
+    return len(json_files), bad
+
+
+def run_local(paths, workers=None, chunk_size=256, reasons=False, **criteria):
+    start = time.time()
 
-                with open(json_file) as f:
-                    if check(f.read()):
-                        groups = PATTERN.search(name)
-                        if groups:
-                            print(groups.group(1))
+    check_chunk = functools.partial(check_files, **criteria)
+    if workers == 1:
+        pool = None
+        results = (check_chunk(c) for c in chunks(json_files(paths), chunk_size))
+    else:
+        pool = multiprocessing.Pool(workers)
+        # imap keeps the order of the files
+        results = pool.imap(check_chunk, chunks(json_files(paths), chunk_size))
+
+    count = 0
+    try:
+        for checked, bad in results:
+            count += checked
+            for name, reason in bad:
+                print_bad(name, reason, reasons)
+    finally:
+        if pool:
+            pool.terminate()
+
+    so_far = time.time() - start
+    sys.stderr.write("Checked {} files in {:.1f}s, {:.1f} files/s\n".format(
+        count, so_far, count / max(so_far, 1e-9)))
 
 
 if __name__ == '__main__':
@@ -162,11 +356,36 @@ if __name__ == '__main__':
     if arguments['--debug']:
         logging.basicConfig(level=logging.DEBUG)
 
+    criteria = {
+        'min_boxes': int(arguments['--min-boxes']),
+        'border': float(arguments['--border']),
+        'text_ratio': float(arguments['--text-ratio']),
+    }
+
     if arguments['read-s3']:
+        ranges = None
+        if arguments['--ranges']:
+            ranges = read_lines(arguments['--ranges'])
+            if len(ranges) != int(arguments['--of']) - 1:
+                sys.exit("The ranges are for {} parts".format(len(ranges) + 1))
+        manifest = None
+        if arguments['--manifest']:
+            manifest = read_lines(arguments['--manifest'])
         run_s3(arguments['S3-BUCKET'], arguments['S3-PATH'],
-               int(arguments['--chunk']), int(arguments['--of']))
+               int(arguments['--chunk']), int(arguments['--of']),
+               ranges, manifest, int(arguments['--threads']),
+               arguments['--reasons'], **criteria)
+    elif arguments['ranges']:
+        for boundary in key_ranges(arguments['S3-BUCKET'],
+                                   arguments['S3-PATH'], int(arguments['--of'])):
+            print(boundary)
     elif arguments['read']:
-        run_local(arguments['PATH'])
+        workers = None
+        if arguments['--workers']:
+            workers = int(arguments['--workers'])
+        run_local(arguments['PATH'], workers, int(arguments['--chunk-size']),
+                  arguments['--reasons'], **criteria)
     elif arguments['check']:
         with open(arguments['FILE']) as f:
-            print("Bad label" if check(f.read()) else "Good label")
+            reason = bad_reason(json.load(f), **criteria)
+            print("Bad label ({})".format(reason) if reason else "Good label")
@@ -13,49 +13,358 @@ to a directory with the following structure:
  /text-masked
   - filename_figno_box.png
   - filename_figno_mask.png
+ /manifests
+  - filename-manifest.json
+
+The manifest records the parameters and outputs of every stage (figures,
+render, labels). When a PDF file is processed again, stages whose inputs
+and parameters did not change are skipped (use --force to run them anyway).
+
+The batch command processes many PDF files with a pool of long-running
+workers. LIST is a file with one PDF per line (use - to read from stdin).
+With --s3-in, the lines are keys in that bucket and the outputs are
+uploaded to S3-PATH in the --s3-out bucket (default: the input bucket).
+Otherwise, the lines are local files and the outputs are written to PATH.
+
+With --shards, the outputs of many documents are packed into tar files of
+about --shard-size MB with an index (see shards.py) that are written to
+PATH/shards or uploaded to S3-PATH/shards instead of one file per output.
 
 Usage:
-  label_gen.py read-s3 S3-IN-BUCKET S3-FILE S3-OUT-BUCKET S3-PATH [--use-ramdisk] [--debug] [--dbg-image]
-  label_gen.py read FILE PATH [--debug] [--dbg-image]
+  label_gen.py read-s3 S3-IN-BUCKET S3-FILE S3-OUT-BUCKET S3-PATH [--use-ramdisk] [--debug] [--dbg-image] [--factors=FACTORS] [--downsample] [--renderer=NAME] [--label-format=FORMAT] [--upload-threads=N] [--timeout=SECONDS] [--shards] [--shard-size=MB] [--filter=MODE] [--force] [--metrics=PREFIX] [--metrics-format=FORMAT]
+  label_gen.py read FILE PATH [--debug] [--dbg-image] [--factors=FACTORS] [--downsample] [--renderer=NAME] [--label-format=FORMAT] [--timeout=SECONDS] [--filter=MODE] [--force] [--metrics=PREFIX] [--metrics-format=FORMAT]
+  label_gen.py batch LIST PATH [--s3-in=BUCKET] [--s3-out=BUCKET] [--workers=N] [--prefetch=N] [--upload-threads=N] [--use-ramdisk] [--debug] [--dbg-image] [--factors=FACTORS] [--downsample] [--renderer=NAME] [--label-format=FORMAT] [--timeout=SECONDS] [--shards] [--shard-size=MB] [--filter=MODE] [--force] [--metrics=PREFIX] [--metrics-format=FORMAT]
   label_gen.py (-h | --help)
   label_gen.py --version
 
 Options:
-  --use-ramdisk   Store temporary files in /tmp/ram/.
-  --debug         Write debug output.
-  --dbg-image     Create a debug label.
-  -h --help       Show this screen.
-  --version       Show version.
+  --use-ramdisk        Store temporary files in /tmp/ram/.
+  --s3-in=BUCKET       Read the PDF files from this S3 bucket.
+  --s3-out=BUCKET      Write the outputs to this S3 bucket.
+  --workers=N          Number of worker processes [default: 1].
+  --prefetch=N         Number of PDF files to download and run pdffigures on
+                       ahead of time [default: 2].
+  --upload-threads=N   Number of threads that upload outputs to S3
+                       [default: 8].
+  --debug              Write debug output.
+  --dbg-image          Create a debug label.
+  --factors=FACTORS    Comma separated list of resolutions to render in
+                       multiples of 100 DPI. 1x is always rendered because
+                       the labels are generated for it [default: 1,2].
+  --downsample         Rasterize each page once at the highest resolution and
+                       downsample it for the lower resolutions.
+  --renderer=NAME      Backend to rasterize pages with. wand uses imagemagick
+                       and ghostscript, mupdf renders in-process with PyMuPDF
+                       [default: wand].
+  --label-format=FORMAT
+                       png writes one label image per figure. boxes writes
+                       the text boxes and the dilation of all labels of a
+                       document into one file (filename-labels.jsonl).
+                       json writes no labels, they are computed from the
+                       JSON of the figures when needed (see
+                       label_image.synthesize_label) [default: png].
+  --timeout=SECONDS    Give up on a PDF file if pdffigures takes longer
+                       [default: 300].
+  --filter=MODE        Check the figures with the criteria of find_bad.py
+                       before they are rendered. skip does not render bad
+                       figures, tag renders them and adds the reason to
+                       their JSON ("Bad").
+  --force              Run all stages again, even if the manifest of an earlier
+                       run shows that their inputs and parameters did not
+                       change.
+  --shards             Pack the outputs into large tar files.
+  --shard-size=MB      Start a new shard when it is larger [default: 1024].
+  --metrics=PREFIX     Write the time spent in each stage and the number of
+                       figures found, skipped and labeled by every process to
+                       PREFIX-HOST-PID.jsonl (or .prom, see metrics.py).
+  --metrics-format=FORMAT
+                       json appends one record per document, prometheus
+                       writes the totals in the Prometheus text format
+                       [default: json].
+  -h --help            Show this screen.
+  --version            Show version.
 """
 
 import tempfile
 import shutil
 import subprocess
+import threading
+import collections
+import functools
+import fcntl
+import io
 import os
+import sys
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from docopt import docopt
-from boto.s3.connection import S3Connection
 from boto.s3.key import Key
+from boto.exception import S3ResponseError
 
-import config
+import s3util
+import shards
 import render
 import label_image
+import find_bad
+import manifest
+import metrics
+import workerpool
 
 
 DEBUG = False
 
+PDFFIGURES = 'pdffigures/pdffigures'
+
+# seconds before we give up on a pdf file
+PDFFIGURES_TIMEOUT = 300
+
+# directories of the outputs of run_local
+OUTPUT_DIRS = ['json', 'img', 'text-masked', 'manifests']
+STAGE_DIRS = {'figures': 'json', 'render': 'img', 'labels': 'text-masked'}
+
 
 def create_dir(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
 
-def run_local(pdf_file, path, debug_image, flat):
+def parse_factors(factors):
+    """Parses a comma separated list of resolution factors."""
+    return sorted(set([1] + [int(f) for f in factors.split(',') if f]))
+
+
+class ExtractionError(Exception):
+    pass
+
+
+def iter_json_array(fh, chunk_size=64*1024):
+    """Yields the objects in a JSON array as soon as they have been read
+    from the file object, without waiting for the rest of the array.
+    """
+
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+
+    for chunk in iter(lambda: fh.read(chunk_size), ''):
+        buf = buf[pos:] + chunk
+        pos = 0
+
+        while True:
+            # skip whitespace and separators between the objects
+            while pos < len(buf) and (buf[pos].isspace() or
+                                      (started and buf[pos] == ',')):
+                pos += 1
+            if pos == len(buf):
+                break
+
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('Expected a JSON array')
+                started = True
+                pos += 1
+                continue
+
+            if buf[pos] == ']':
+                return
+
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # incomplete object, read more
+                break
+            yield obj
+
+    if started:
+        raise ValueError('Unexpected end of JSON array')
+
+
+def _close_on_exit(process, fd, exited):
+    process.wait()
+    exited.append(time.time())
+    os.close(fd)
+
+
+def extract_figures(pdf_file, prefix, timeout=None, stats=None):
+    """Runs pdffigures and yields the figures while its output is parsed.
+
+    pdffigures writes the JSON into a named pipe at prefix.json, so it never
+    touches the disk. pdffigures is killed if it takes longer than timeout
+    seconds. The time it took is stored in stats['pdffigures'].
+    """
+
+    start = time.time()
+    timeout = timeout or PDFFIGURES_TIMEOUT
+
+    json_file = '{}.json'.format(prefix)
+    os.mkfifo(json_file)
+
+    # Hold our own write end until pdffigures has exited. Otherwise, we
+    # would see the end of the file before pdffigures has opened the pipe
+    # or block forever if it never does.
+    read_fd = os.open(json_file, os.O_RDONLY | os.O_NONBLOCK)
+    write_fd = os.open(json_file, os.O_WRONLY)
+    flags = fcntl.fcntl(read_fd, fcntl.F_GETFL)
+    fcntl.fcntl(read_fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen([PDFFIGURES, '-j', prefix, pdf_file],
+                                       stdout=devnull, stderr=devnull,
+                                       close_fds=True)
+    except OSError:
+        os.close(read_fd)
+        os.close(write_fd)
+        os.remove(json_file)
+        raise
+
+    exited = []
+    waiter = threading.Thread(target=_close_on_exit,
+                              args=(process, write_fd, exited))
+    waiter.daemon = True
+    waiter.start()
+
+    def kill():
+        try:
+            process.kill()
+        except OSError:
+            # already exited
+            pass
+
+    timed_out = threading.Event()
+
+    def on_timeout():
+        timed_out.set()
+        kill()
+
+    timer = threading.Timer(timeout, on_timeout)
+    timer.daemon = True
+    timer.start()
+
+    count = 0
+    finished = False
+    try:
+        with io.open(read_fd, encoding='utf-8', errors='replace') as fh:
+            try:
+                for figure in iter_json_array(fh):
+                    count += 1
+                    yield figure
+                finished = True
+            except ValueError as e:
+                if not timed_out.is_set():
+                    raise ExtractionError(
+                        'Invalid output from pdffigures: {}'.format(e))
+    finally:
+        if not finished:
+            # we stopped reading early, pdffigures may block on the pipe
+            kill()
+        waiter.join()
+        timer.cancel()
+        os.remove(json_file)
+
+    if timed_out.is_set():
+        raise ExtractionError(
+            'pdffigures timed out after {}s'.format(timeout))
+
+    # the figures may have been consumed slower than pdffigures ran
+    seconds = exited[0] - start
+    logging.debug('pdffigures found {} figures in {:.2f}s'.format(
+        count, seconds))
+    metrics.add_time('pdffigures', seconds)
+    metrics.count('figures', count, state='found')
+    if stats is not None:
+        stats['pdffigures'] = seconds
+
+
+def stage_params(pdf_hash, renderer_class, debug_image, factors=(1, 2),
+                 downsample=False, label_format='png', bad_figures=None):
+    """Returns the parameters of every stage for the manifest."""
+
+    figures = {
+        'pdf': pdf_hash,
+        'pdffigures': manifest.tool_hash(PDFFIGURES),
+        'filter': bad_figures,
+        'criteria': [find_bad.MIN_BOXES, find_bad.BORDER, find_bad.TEXT_RATIO],
+    }
+    rendered = {
+        'figures': manifest.params_hash(figures),
+        'factors': list(factors),
+        'downsample': downsample,
+        'renderer': renderer_class.__name__,
+        'version': render.renderer_version(renderer_class),
+    }
+    labels = {
+        'render': manifest.params_hash(rendered),
+        'format': label_format,
+        'dilation': label_image.DILATION,
+        'debug_image': bool(debug_image),
+    }
+    return {'figures': figures, 'render': rendered, 'labels': labels}
+
+
+def manifest_file(path, ident, flat):
+    if flat:
+        return os.path.join(path, '{}-manifest.json'.format(ident))
+    return os.path.join(path, 'manifests', '{}-manifest.json'.format(ident))
+
+
+def load_figures(json_path, names):
+    """Reads the figures that an earlier run wrote."""
+    for name in names:
+        index = int(name.rsplit('-Figure-', 1)[1].split('.')[0])
+        with open(os.path.join(json_path, name)) as f:
+            yield index, json.load(f)
+
+
+def filter_figures(figures, bad_figures, bad):
+    """Yields the index and the figure of the figures that are not skipped
+    and counts the bad figures per reason.
+    """
+    for index, figure in enumerate(figures):
+        if bad_figures:
+            reason = find_bad.bad_reason(figure)
+            if reason:
+                bad[reason] += 1
+                if bad_figures == 'skip':
+                    logging.debug('Skip figure {} ({})'.format(index, reason))
+                    continue
+                figure['Bad'] = reason
+        yield index, figure
+
+
+def run_local(pdf_file, path, debug_image, flat, factors=(1, 2),
+              downsample=False, renderer=None, figures=None, stats=None,
+              label_format='png', bad_figures=None, force=False,
+              timeout=None):
+    """Extracts the figures of one pdf file and renders images and labels.
+
+    If the figures have already been extracted with extract_figures, pass
+    them in to skip pdffigures. Otherwise, the figures are rendered while
+    the output of pdffigures is parsed.
+
+    With the boxes label format, the labels of all figures are written as
+    compact records into one file instead of one image per figure.
+
+    If bad_figures is skip or tag, figures that find_bad considers bad are
+    not rendered or are tagged with the reason. The number of bad figures
+    per reason is counted in stats['bad'].
+
+    The stages that produced the outputs are recorded in a manifest. Stages
+    whose parameters and inputs did not change since the last run are
+    skipped (unless force is set), e.g. only the labels are generated again
+    if the label format changes.
+    """
+
     filepath = os.path.abspath(pdf_file)
     outpath = os.path.abspath(path)
 
+    # the labels are generated for the 1x images
+    factors = sorted(set(factors) | set([1]))
+
     ident = os.path.splitext(os.path.basename(pdf_file))[0]
 
     if flat:
@@ -72,110 +381,608 @@ def run_local(pdf_file, path, debug_image, flat):
         create_dir(json_path)
         create_dir(img_path)
         create_dir(label_path)
+        create_dir(os.path.join(outpath, 'manifests'))
 
     outident_json = os.path.join(json_path, ident)
 
-    # generate the json for figures
-    logging.debug('Run pdffigures {}'.format(filepath))
-    DEVNULL = open(os.devnull, 'w')
-    subprocess.call(['pdffigures/pdffigures', '-j',
-                    outident_json, filepath], stdout=DEVNULL, stderr=DEVNULL)
+    # all figures on a page are cropped from the same rendering
+    cache = render.PageCache(renderer=renderer)
+
+    # render once at the highest resolution, the others are downsampled
+    source_dpi = int(max(factors)*100) if downsample else None
+
+    doc = manifest.Manifest(manifest_file(outpath, ident, flat))
+    params = stage_params(manifest.file_hash(filepath), type(cache.renderer),
+                          debug_image, factors, downsample, label_format,
+                          bad_figures)
+    current = set()
+    if not force:
+        current = doc.current_stages(params, {
+            'figures': json_path, 'render': img_path, 'labels': label_path})
+    logging.debug('Reuse stages {}'.format(', '.join(sorted(current))))
+    for stage in current:
+        metrics.count('reused_stages', stage=stage)
+
+    bad = collections.Counter()
+    if 'figures' in current:
+        figures = load_figures(json_path, doc.outputs('figures'))
+        bad.update(doc.get('figures', 'bad', {}))
+    else:
+        if figures is None:
+            # generate the json for figures
+            logging.debug('Run pdffigures {}'.format(filepath))
+            figures = extract_figures(filepath, outident_json, timeout,
+                                      stats=stats)
+        figures = filter_figures(figures, bad_figures, bad)
 
     json_files = []
     img_files = []
     label_files = []
 
-    logging.debug("Finished. Now look for the JSON and generate labels.")
+    if label_format == 'boxes':
+        # one file for the labels of all figures
+        labels_file = os.path.join(label_path, '{}-labels.jsonl'.format(ident))
+        if 'labels' not in current and os.path.exists(labels_file):
+            os.remove(labels_file)
 
     # pdffigures now generates only a singe JSON file, we need one file per figure
     # https://github.com/allenai/pdffigures/commit/8ffcaceab3fdc97ec489c58e87191b7e12c0134a
 
-    json_file = '{}.json'.format(outident_json)
-
-    if os.path.isfile(json_file):
-        with open(json_file) as fh:
-            figures = json.load(fh)
-
-
-            logging.debug('Found {} figures'.format(len(figures)))
-
-            for index, figure in enumerate(figures):
-                chart_json = '{}-Figure-{}.json'.format(outident_json, index)
-                json_files.append(chart_json)
-
-                with open(chart_json, 'w') as jfh:
-                    json.dump(figure, jfh)
-
-                def image_path(factor):
-                    ext = '' if factor == 1 else '-{}x'.format(factor)
-                    name = '{}-Figure-{}{}.png'.format(ident, index, ext)
-                    return os.path.join(img_path, name)
-
-                # render image with different resolutions
-                for factor in [1, 2]:
-                    image_file = image_path(factor)
-                    logging.debug('Render image {} from {}'.format(
-                        image_file, filepath))
-
-                    render.render_chart(filepath, figure['Page']-1,
-                                        figure['ImageBB'],
-                                        int(factor*100), image_file)
-                    img_files.append(image_file)
-
-                # labeled image
-                output = os.path.join(
-                    label_path, '{}-Figure-{}-label.png'.format(
-                        ident, index, factor))
-                dbg_output = None
-                if debug_image:
-                    dbg_output = os.path.join(
-                        label_path, '{}-Figure-{}-dbg.png'.format(
-                            ident, index, factor))
-
-                logging.debug('generate label {}'.format(output))
-                if label_image.gen_labeled_image(
-                        figure, image_path(1), output, dbg_output, DEBUG):
-                    # yes, a labeled file was generated
-                    label_files.append(output)
-                    if dbg_output:
-                        label_files.append(dbg_output)
-
-        # remove the one json file with data for all figures
-        os.remove(json_file)
+    for index, figure in figures:
+        chart_json = '{}-Figure-{}.json'.format(outident_json, index)
+        json_files.append(chart_json)
 
-    return json_files, img_files, label_files
+        if 'figures' not in current:
+            with open(chart_json, 'w') as jfh:
+                json.dump(figure, jfh)
 
+        def image_path(factor):
+            ext = '' if factor == 1 else '-{}x'.format(factor)
+            name = '{}-Figure-{}{}.png'.format(ident, index, ext)
+            return os.path.join(img_path, name)
 
-def run_s3(in_bucket_name, filename, out_bucket_name, path, ramtemp, debug_image):
-    conn = S3Connection(config.access_key, config.secret_key, is_secure=False)
-    in_bucket = conn.get_bucket(in_bucket_name)
-    out_bucket = conn.get_bucket(out_bucket_name)
+        # render image with different resolutions
+        for factor in factors:
+            image_file = image_path(factor)
+            img_files.append(image_file)
 
-    dirpath = tempfile.mkdtemp(dir='/tmp/ram/' if ramtemp else None)
-    logging.debug('Temp directory in {}'.format(dirpath))
+            if 'render' in current:
+                continue
 
-    try:
-        # copy into temp
-        key = Key(in_bucket, filename)
-        target = os.path.join(dirpath, os.path.basename(filename))
+            logging.debug('Render image {} from {}'.format(
+                image_file, filepath))
+
+            chart = render.render_chart(
+                filepath, figure['Page']-1, figure['ImageBB'],
+                int(factor*100), image_file, cache, source_dpi)
+
+            if factor == 1:
+                # keep the pixels so we don't have to read them again
+                chart_1x = chart
+
+        if 'labels' in current or label_format == 'json':
+            continue
+
+        if 'render' in current:
+            # only read the image if we need it
+            chart_1x = image_path(1)
+
+        # labeled image
+        if label_format == 'boxes':
+            output = labels_file
+        else:
+            output = os.path.join(
+                label_path, '{}-Figure-{}-label.png'.format(ident, index))
+        dbg_output = None
+        if debug_image:
+            dbg_output = os.path.join(
+                label_path, '{}-Figure-{}-dbg.png'.format(ident, index))
+
+        logging.debug('generate label {}'.format(output))
+        if label_image.gen_labeled_image(
+                figure, chart_1x, output, dbg_output, DEBUG, label_format,
+                '{}-Figure-{}'.format(ident, index)):
+            # yes, a labeled file was generated
+            metrics.count('figures', state='labeled')
+            if output not in label_files:
+                label_files.append(output)
+            if dbg_output:
+                label_files.append(dbg_output)
+
+    if 'labels' in current:
+        label_files = [os.path.join(label_path, name)
+                       for name in doc.outputs('labels')]
+
+    logging.debug('Processed {} figures'.format(len(json_files)))
+    if 'figures' not in current:
+        for reason, count in bad.items():
+            metrics.count('bad_figures', count, reason=reason)
+        if bad_figures == 'skip':
+            metrics.count('figures', sum(bad.values()), state='skipped')
+    if stats is not None and bad_figures:
+        stats['bad'] = bad
+
+    if 'figures' not in current:
+        doc.record('figures', params['figures'], json_files, bad=bad)
+    if 'render' not in current:
+        doc.record('render', params['render'], img_files)
+    if 'labels' not in current:
+        doc.record('labels', params['labels'], label_files)
+    doc.save()
+
+    return json_files, img_files, label_files, [doc.filename]
+
+
+def describe_error(e):
+    """First line of the error message for the progress output."""
+    return (str(e).strip().splitlines() or [type(e).__name__])[0]
+
+
+def describe_bad(bad):
+    """Summary of the bad figures per reason for stderr."""
+    return '{} bad figures ({})\n'.format(
+        sum(bad.values()), ', '.join(
+            '{} {}'.format(count, reason) for reason, count in sorted(bad.items())))
+
+
+def download(bucket_name, name, dirpath):
+    """Copies a file from S3 into dirpath and returns the local file name."""
+    key = Key(s3util.get_bucket(bucket_name), name)
+    target = os.path.join(dirpath, os.path.basename(name))
+    with metrics.timer('s3_download'):
         key.get_contents_to_filename(target)
+    metrics.count('s3_bytes', os.path.getsize(target), direction='download')
+    return target
+
+
+def upload(bucket_name, name, filename):
+    key = Key(s3util.get_bucket(bucket_name), name)
+    with metrics.timer('s3_upload'):
+        key.set_contents_from_filename(filename)
+    metrics.count('s3_bytes', os.path.getsize(filename), direction='upload')
+
+
+def output_keys(path, files):
+    """Returns pairs of S3 key names and local files for the outputs
+    of run_local (json, images, labels and the manifest).
+    """
+    keys = []
+    for directory, names in zip(OUTPUT_DIRS, files):
+        for f in names:
+            keys.append((os.path.join(path, directory, os.path.basename(f)), f))
+    return keys
+
+
+def previous_stages(pdf_file, dirpath, settings):
+    """Returns the stages of an earlier run of a batch whose outputs can be
+    reused. With S3, the manifest and these outputs are downloaded into
+    dirpath, unless all stages are current.
+    """
 
-        # run algos
-        files = run_local(target, dirpath, debug_image, True)
-
-        # write files back to s3
-        for f in files[0]:
-            key = Key(out_bucket, os.path.join(path, 'json', os.path.basename(f)))
-            key.set_contents_from_filename(f)
-        for f in files[1]:
-            key = Key(out_bucket, os.path.join(path, 'img', os.path.basename(f)))
-            key.set_contents_from_filename(f)
-        for f in files[2]:
-            key = Key(out_bucket, os.path.join(
-                path, 'text-masked', os.path.basename(f)))
-            key.set_contents_from_filename(f)
+    options = settings['options']
+    if options.get('force'):
+        return set()
+
+    ident = os.path.splitext(os.path.basename(pdf_file))[0]
+    params = stage_params(
+        manifest.file_hash(pdf_file),
+        render.RENDERERS[settings['renderer']], settings['debug_image'],
+        **dict((k, v) for k, v in options.items() if k != 'force'))
+
+    if not settings['s3_in']:
+        path = os.path.abspath(settings['path'])
+        doc = manifest.Manifest(manifest_file(path, ident, False))
+        return doc.current_stages(params, dict(
+            (stage, os.path.join(path, STAGE_DIRS[stage]))
+            for stage in manifest.STAGES))
+
+    bucket_name = settings['s3_out'] or settings['s3_in']
+    try:
+        download(bucket_name, os.path.join(
+            settings['path'], 'manifests', '{}-manifest.json'.format(ident)),
+            dirpath)
+    except S3ResponseError as e:
+        if e.status == 404:
+            return set()
+        raise
+
+    # outputs are uploaded before the manifest, so we don't check them
+    doc = manifest.Manifest(manifest_file(dirpath, ident, True))
+    current = doc.current_stages(params)
+    if current == set(manifest.STAGES):
+        return current
+
+    try:
+        for stage in current:
+            for name in doc.outputs(stage):
+                download(bucket_name, os.path.join(
+                    settings['path'], STAGE_DIRS[stage], name), dirpath)
+    except S3ResponseError as e:
+        # the stages will run again
+        logging.warning('Could not restore outputs of {}: {}'.format(
+            pdf_file, e))
+    return current
+
+
+def fetch(name, dirpath, settings):
+    """Downloads a document (if it is on S3) and extracts its figures,
+    unless they can be reused from an earlier run (see run_local).
+
+    Returns the local file, the figures (or None) and the time the steps
+    took. If all outputs are up to date, stats['unchanged'] is set.
+    """
+
+    stats = {}
+    if settings['s3_in']:
+        start = time.time()
+        pdf_file = download(settings['s3_in'], name, dirpath)
+        stats['download'] = time.time() - start
+    else:
+        pdf_file = name
+
+    current = set()
+    if settings['resume']:
+        current = previous_stages(pdf_file, dirpath, settings)
+
+    figures = None
+    if current == set(manifest.STAGES):
+        stats['unchanged'] = True
+    elif 'figures' not in current:
+        figures = list(extract_figures(
+            pdf_file, os.path.join(dirpath, '.pdffigures'),
+            settings['timeout'], stats=stats))
+    return pdf_file, figures, stats
+
+
+def prefetch(names, fetch_document, scratch, slots, executor):
+    """Downloads documents and extracts their figures ahead of time in
+    background threads, so that pdffigures runs while the workers render
+    the previous documents.
+
+    Every document is fetched with fetch_document(name, dirpath). Yields
+    (name, dirpath, pdf file, figures, stats, exception) in the order of
+    names. Every document gets its own directory in scratch and holds one of
+    the slots (a semaphore) until it has been released by the consumer. This
+    bounds the number of documents that are in flight.
+    """
+
+    pending = collections.deque()
+
+    def finish(item):
+        name, dirpath, future = item
+        try:
+            pdf_file, figures, stats = future.result()
+            return name, dirpath, pdf_file, figures, stats, None
+        except Exception as e:
+            logging.exception('Failed to fetch {}'.format(name))
+            return name, dirpath, None, None, {}, e
+
+    for name in names:
+        # pass on fetched documents while we wait for a free slot,
+        # otherwise nothing would ever release one
+        while not slots.acquire(False):
+            if pending:
+                yield finish(pending.popleft())
+            else:
+                slots.acquire()
+                break
+
+        dirpath = tempfile.mkdtemp(dir=scratch)
+        pending.append((name, dirpath, executor.submit(
+            fetch_document, name, dirpath)))
+
+    while pending:
+        yield finish(pending.popleft())
+
+
+class Uploads(object):
+    """Uploads the outputs of documents with a bounded thread pool.
+
+    When all files of a document are uploaded, its directory is removed
+    and its slot is released.
+    """
+
+    def __init__(self, bucket_name, path, slots, threads):
+        self.bucket_name = bucket_name
+        self.path = path
+        self.slots = slots
+        self.executor = ThreadPoolExecutor(threads)
+        self.failed = []
+        self.errors = []
+        self._lock = threading.Lock()
+
+        # documents and shards that are not completely uploaded yet
+        self._pending = 0
+        self._idle = threading.Condition(self._lock)
+
+    def _start(self):
+        with self._lock:
+            self._pending += 1
+
+    def _finish(self):
+        with self._lock:
+            self._pending -= 1
+            self._idle.notify_all()
+
+    def submit(self, name, dirpath, files):
+        keys = output_keys(self.path, files) if files else []
+
+        # the manifest is uploaded last, so that it never lists missing outputs
+        split = len(keys) - len(files[-1]) if files else 0
+        outputs, manifests = keys[:split], keys[split:]
+
+        def done(error):
+            shutil.rmtree(dirpath, ignore_errors=True)
+            self.slots.release()
+            self._finish()
+
+        def uploaded(error):
+            if error:
+                done(error)
+            else:
+                self._upload(name, manifests, done)
+
+        self._start()
+        self._upload(name, outputs, uploaded)
+
+    def submit_shard(self, tar_file, index_file):
+        """Uploads a closed shard and its index and removes them."""
+        keys = [(os.path.join(self.path, 'shards', os.path.basename(f)), f)
+                for f in [tar_file, index_file]]
+
+        def done(error):
+            for f in [tar_file, index_file]:
+                os.remove(f)
+            self._finish()
+
+        self._start()
+        self._upload(os.path.basename(tar_file), keys, done)
+
+    def _upload(self, name, keys, done):
+        """Uploads (key name, file) pairs and calls done when all are
+        finished.
+        """
+
+        if not keys:
+            self._done(name, None, done)
+            return
+
+        remaining = [len(keys)]
+        errors = []
+
+        def uploaded(future):
+            with self._lock:
+                if future.exception():
+                    errors.append(future.exception())
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                self._done(name, errors[0] if errors else None, done)
+
+        for key_name, filename in keys:
+            future = self.executor.submit(
+                upload, self.bucket_name, key_name, filename)
+            future.add_done_callback(uploaded)
+
+    def _done(self, name, error, done):
+        if error:
+            logging.error('Failed to upload {}: {}'.format(name, error))
+            self.failed.append(name)
+            self.errors.append(error)
+        done(error)
+
+    def wait(self):
+        # uploads can submit more uploads (e.g. the manifest)
+        with self._lock:
+            while self._pending:
+                self._idle.wait()
+        self.executor.shutdown(wait=True)
+
+
+def run_s3(in_bucket_name, filename, out_bucket_name, path, ramtemp, debug_image,
+           renderer='wand', upload_threads=8, shard_size=None, timeout=None,
+           **options):
+    """Processes one file from S3. The options are passed to run_local.
+    Errors are raised.
+    """
+    run_batch([filename], path, in_bucket_name, out_bucket_name, 0, ramtemp,
+              debug_image, renderer, upload_threads=upload_threads,
+              shard_size=shard_size, timeout=timeout, raise_errors=True,
+              **options)
+
+
+# state of a batch worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(settings):
+    _worker.update(settings)
+    _worker['renderer'] = render.get_renderer(settings['renderer'])
+
+    # every worker writes its own metrics
+    metrics.reset()
+    if settings['metrics']:
+        metrics.configure(*settings['metrics'])
+
+
+def _process_document(item):
+    """Processes one document from prefetch in a batch worker.
+
+    Returns the name, the scratch directory of the document, the output
+    files (or None), the time the steps took and an error message if
+    processing failed.
+    """
+
+    name, dirpath, pdf_file, figures, stats, error = item
+    if error or stats.get('unchanged'):
+        return name, dirpath, None, stats, error
+
+    start = time.time()
+    try:
+        if _worker['flat']:
+            # write everything next to the downloaded file
+            files = run_local(
+                pdf_file, dirpath, _worker['debug_image'], True,
+                renderer=_worker['renderer'], figures=figures, stats=stats,
+                timeout=_worker['timeout'], **_worker['options'])
+        else:
+            files = run_local(
+                pdf_file, _worker['path'], _worker['debug_image'], False,
+                renderer=_worker['renderer'], figures=figures, stats=stats,
+                timeout=_worker['timeout'], **_worker['options'])
+        error = None
+    except Exception as e:
+        if _worker['raise_errors']:
+            raise
+        logging.exception('Failed to process {}'.format(name))
+        files = None
+        error = describe_error(e)
+
+    stats['render'] = time.time() - start
+    metrics.flush(document=name)
+    return name, dirpath, files, stats, error
+
+
+def read_list(list_file):
+    """Reads the names of the documents from a file or stdin (-)."""
+    fh = sys.stdin if list_file == '-' else open(list_file)
+    try:
+        return [line.strip() for line in fh if line.strip()]
+    finally:
+        if fh is not sys.stdin:
+            fh.close()
+
+
+def run_batch(names, path, s3_in, s3_out, workers, ramtemp, debug_image,
+              renderer='wand', prefetch_count=2, upload_threads=8,
+              shard_size=None, timeout=None, raise_errors=False, **options):
+    """Processes many documents with a pool of long-running workers
+    (or in this process if workers is 0). The options are passed to
+    run_local. Returns the number of documents that failed, or raises the
+    first error with raise_errors (only if workers is 0).
+
+    This process downloads the next documents (with S3) and runs pdffigures
+    on them while the workers render, with up to prefetch_count documents
+    waiting for a worker. Outputs are uploaded concurrently with a pool of
+    upload_threads threads. Reports the time per document and the
+    throughput on stderr.
+
+    If shard_size is set, the outputs are packed into shards of about
+    shard_size bytes instead.
+
+    Documents whose outputs are up to date (see run_local) are skipped and
+    stages of earlier runs are reused, except with shards.
+    """
+
+    settings = {
+        'path': path,
+        's3_in': s3_in,
+        's3_out': s3_out,
+        # the manifests of earlier runs are not available in shards
+        'resume': not shard_size,
+        # the outputs stay in the directory of the document until they
+        # are uploaded or packed
+        'flat': bool(s3_in or shard_size),
+        'debug_image': debug_image,
+        'renderer': renderer,
+        'timeout': timeout,
+        'options': options,
+        'metrics': metrics.settings(),
+        'raise_errors': raise_errors,
+    }
+
+    scratch = tempfile.mkdtemp(dir='/tmp/ram/' if ramtemp else None)
+    logging.debug('Temp directory in {}'.format(scratch))
+
+    # documents that are being fetched, processed or uploaded
+    in_flight = max(workers, 1) + prefetch_count
+    slots = threading.BoundedSemaphore(in_flight)
+    fetches = ThreadPoolExecutor(in_flight)
+    items = prefetch(names, functools.partial(fetch, settings=settings),
+                     scratch, slots, fetches)
+
+    def checked(items):
+        # exceptions of the fetches are described before they are passed
+        # to the workers
+        for name, dirpath, pdf_file, figures, stats, error in items:
+            if error is not None:
+                if raise_errors:
+                    raise error
+                error = describe_error(error)
+            yield name, dirpath, pdf_file, figures, stats, error
+    results = workerpool.imap(_process_document, checked(items), workers,
+                              _init_worker, (settings,))
+
+    uploads = None
+    if s3_in:
+        uploads = Uploads(s3_out or s3_in, path, slots, upload_threads)
+
+    writer = None
+    if shard_size and uploads:
+        writer = shards.ShardWriter(os.path.join(scratch, 'shards'),
+                                    max_bytes=shard_size,
+                                    on_close=uploads.submit_shard)
+    elif shard_size:
+        writer = shards.ShardWriter(os.path.join(path, 'shards'),
+                                    max_bytes=shard_size)
+
+    start = time.time()
+    failed = 0
+    bad = collections.Counter()
+    try:
+        for i, (name, dirpath, files, stats, error) in enumerate(results, 1):
+            if error:
+                failed += 1
+                status = 'failed: {}'.format(error)
+                metrics.count('documents', state='failed')
+            elif stats.get('unchanged'):
+                status = 'unchanged'
+                metrics.count('documents', state='unchanged')
+            else:
+                status = '{} files'.format(sum(len(f) for f in files))
+                metrics.count('documents', state='processed')
+            if stats.get('bad'):
+                bad.update(stats['bad'])
+                status += ', {} bad figures'.format(sum(stats['bad'].values()))
+
+            if writer and files:
+                with metrics.timer('pack_shard'):
+                    writer.add_files([f for group in files for f in group])
+
+            if uploads and not writer:
+                # upload in the background while the next document is processed
+                uploads.submit(name, dirpath, None if error else files)
+            else:
+                shutil.rmtree(dirpath, ignore_errors=True)
+                slots.release()
+
+            times = ['{} {:.2f}s'.format(step, stats[step])
+                     for step in ['download', 'pdffigures', 'render']
+                     if step in stats]
+            detail = '{} ({})'.format(name, ', '.join(times + [status]))
+            workerpool.progress(i, len(names), 'documents', start, detail,
+                                end='\n')
+            # downloads, pdffigures and uploads of any document run in
+            # this process, so they are not flushed under this document
+            metrics.flush(stage='fetch_upload')
+
+        if writer:
+            writer.close()
+        if uploads:
+            uploads.wait()
+            failed += len(uploads.failed)
+            if raise_errors and uploads.errors:
+                raise uploads.errors[0]
+        fetches.shutdown()
+        metrics.flush(stage='fetch_upload')
     finally:
-        shutil.rmtree(dirpath)
+        results.close()
+        shutil.rmtree(scratch)
+
+    workerpool.summary('Processed', len(names), 'documents', start, failed)
+    if options.get('bad_figures'):
+        sys.stderr.write(describe_bad(bad))
+    return failed
 
 
 if __name__ == '__main__':
@@ -186,10 +993,53 @@ if __name__ == '__main__':
         logging.basicConfig(level=logging.DEBUG)
         logging.getLogger("boto").setLevel(logging.WARNING)
 
-    if arguments['read-s3']:
+    timeout = int(arguments['--timeout'])
+
+    # passed on to run_local
+    options = {
+        'factors': parse_factors(arguments['--factors']),
+        'downsample': arguments['--downsample'],
+        'label_format': arguments['--label-format'],
+        'bad_figures': arguments['--filter'],
+        'force': arguments['--force'],
+    }
+    if options['bad_figures'] not in [None, 'skip', 'tag']:
+        sys.exit('Unknown filter {}. Use skip or tag.'.format(
+            options['bad_figures']))
+
+    if arguments['--metrics']:
+        try:
+            metrics.configure(arguments['--metrics'],
+                              arguments['--metrics-format'])
+        except ValueError as e:
+            sys.exit(str(e))
+
+    shard_size = None
+    if arguments['--shards']:
+        shard_size = int(arguments['--shard-size']) * 1024 * 1024
+
+    if arguments['batch']:
+        failed = run_batch(
+            read_list(arguments['LIST']), arguments['PATH'],
+            arguments['--s3-in'], arguments['--s3-out'],
+            int(arguments['--workers']), arguments['--use-ramdisk'],
+            arguments['--dbg-image'], arguments['--renderer'],
+            int(arguments['--prefetch']), int(arguments['--upload-threads']),
+            shard_size, timeout, **options)
+        if failed:
+            sys.exit(1)
+    elif arguments['read-s3']:
         run_s3(arguments['S3-IN-BUCKET'], arguments['S3-FILE'],
                arguments['S3-OUT-BUCKET'], arguments['S3-PATH'],
-               arguments['--use-ramdisk'], arguments['--dbg-image'])
+               arguments['--use-ramdisk'], arguments['--dbg-image'],
+               arguments['--renderer'], int(arguments['--upload-threads']),
+               shard_size, timeout, **options)
     elif arguments['read']:
+        stats = {}
         run_local(arguments['FILE'], arguments['PATH'],
-                  arguments['--dbg-image'], False)
+                  arguments['--dbg-image'], False,
+                  renderer=render.get_renderer(arguments['--renderer']),
+                  stats=stats, timeout=timeout, **options)
+        metrics.flush(document=arguments['FILE'])
+        if options['bad_figures']:
+            sys.stderr.write(describe_bad(stats['bad']))
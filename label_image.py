@@ -1,63 +1,298 @@
 import json
-import math
 import sys
 import logging
 
 import numpy as np
 import cv2
 
+import metrics
+
 WHITE = (255, 255, 255)
 RED = (0, 0, 255)
 factor = 1
 
+# the label is dilated twice with a 2x2 kernel
+DILATION = 2
 
-def gen_labeled_image(description, image, target, dbg_output=None, debug=False):
-    bounds = np.array(description['ImageBB'])
+# draw labels with fewer boxes one box at a time
+FEW_BOXES = 32
 
-    bounds *= factor
 
-    x0 = bounds[0]
-    y0 = bounds[1]
-    w = bounds[2] - x0
-    h = bounds[3] - y0
+def load_chart(image):
+    """Returns the chart as a grayscale array. The image can be a path or
+    an array that has already been decoded (gray or BGR).
+    """
+    if isinstance(image, np.ndarray):
+        if image.ndim == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image
+    return cv2.imread(image, cv2.CV_LOAD_IMAGE_GRAYSCALE)
 
-    chart = cv2.imread(image, cv2.CV_LOAD_IMAGE_GRAYSCALE)
-    # h, w = chart.shape
 
-    texts = description['ImageText']
+def _pixel_boxes(boxes, origins):
+    """Converts text boxes to integer pixel coordinates relative to the
+    origins (top left corners) of their figures. The boxes are rounded
+    outwards.
+    """
+
+    boxes = np.asarray(boxes, float) * factor
+    boxes -= np.tile(np.asarray(origins, float) * factor, 2)
+    boxes[:, :2] = np.floor(boxes[:, :2])
+    boxes[:, 2:] = np.ceil(boxes[:, 2:])
+    return boxes.astype(int)
+
 
+def text_boxes(description):
+    """Returns the text boxes of a figure as an (N, 4) integer array of
+    x0, y0, x1, y1 (inclusive) relative to the top left of the figure.
+    """
+
+    texts = description['ImageText']
     if len(texts) == 0:
+        return np.zeros((0, 4), int)
+
+    return _pixel_boxes([text['TextBB'] for text in texts],
+                        description['ImageBB'][:2])
+
+
+def label_shape(description):
+    """Returns the height and width of the label for a figure."""
+    bounds = np.array(description['ImageBB']) * factor
+    return int(bounds[3] - bounds[1]), int(bounds[2] - bounds[0])
+
+
+def fill_boxes(boxes, shape, grow=DILATION):
+    """Draws filled boxes (inclusive corners) into a new mask of the given
+    shape. Every box is grown by `grow` pixels to the right and bottom,
+    which is the same as dilating the mask `grow` times with a 2x2 kernel.
+
+    Many boxes are drawn at once: we add +1/-1 at the corners of every box
+    into a difference array and integrate it to get the number of boxes
+    that cover each pixel.
+    """
+
+    h, w = shape
+
+    x0 = np.minimum(boxes[:, 0], boxes[:, 2])
+    x1 = np.maximum(boxes[:, 0], boxes[:, 2])
+    y0 = np.minimum(boxes[:, 1], boxes[:, 3])
+    y1 = np.maximum(boxes[:, 1], boxes[:, 3])
+
+    # boxes outside of the figure are not drawn (and not dilated)
+    inside = (x1 >= 0) & (y1 >= 0) & (x0 < w) & (y0 < h)
+
+    # exclusive end after growing
+    x0 = np.clip(x0[inside], 0, w)
+    y0 = np.clip(y0[inside], 0, h)
+    x1 = np.clip(x1[inside] + grow + 1, 0, w)
+    y1 = np.clip(y1[inside] + grow + 1, 0, h)
+
+    if len(x0) < FEW_BOXES:
+        # cheaper than a pass over all pixels
+        label = np.zeros((h, w), np.uint8)
+        for box in zip(x0, y0, x1 - 1, y1 - 1):
+            tx0, ty0, tx1, ty1 = [int(v) for v in box]
+            cv2.rectangle(label, (tx0, ty0), (tx1, ty1), WHITE,
+                          cv2.cv.CV_FILLED)
+        return label
+
+    diff = np.zeros((h + 1, w + 1), np.float32)
+    np.add.at(diff, (y0, x0), 1)
+    np.add.at(diff, (y0, x1), -1)
+    np.add.at(diff, (y1, x0), -1)
+    np.add.at(diff, (y1, x1), 1)
+
+    # the first row and column of the integral image are zero
+    coverage = cv2.integral(diff[:h, :w], sdepth=cv2.CV_32F)[1:, 1:]
+
+    return (coverage > 0.5).astype(np.uint8) * 255
+
+
+def gen_label(description):
+    """Returns the label for a figure or None if it does not have text."""
+
+    if len(description['ImageText']) == 0:
         logging.debug("""No text boxes in chart. Since this could mean that the image
             does not have embedded text, we are ignoring it.""")
-        return False
+        return None
+
+    # label a box around the text and dilate the label slightly
+    return fill_boxes(text_boxes(description), label_shape(description))
+
+
+def synthesize_label(description, shape=None, grow=DILATION):
+    """Returns the label for a figure at any (height, width), straight from
+    its description, so that labels do not have to be stored as images.
 
-    label = np.zeros((h, w), np.uint8)
+    The text boxes are scaled to the shape and rounded outwards there,
+    instead of scaling a label image. grow is the dilation in pixels at the
+    original size and is scaled with the label. At the original size, the
+    label is the same as the one of gen_label, except that figures without
+    text get an empty label instead of None.
+    """
 
-    for text_box in texts:
-        tb = np.array(text_box['TextBB'])
-        tb *= factor
+    h, w = label_shape(description)
+    if shape is None:
+        shape = (h, w)
+    height, width = shape
+
+    texts = description['ImageText']
+    if len(texts) == 0:
+        return np.zeros((height, width), np.uint8)
 
-        tx0 = int(math.floor(tb[0] - x0))
-        ty0 = int(math.floor(tb[1] - y0))
-        tx1 = int(math.ceil(tb[2] - x0))
-        ty1 = int(math.ceil(tb[3] - y0))
+    sx = 1.0*width/w
+    sy = 1.0*height/h
 
-        # label exactly the text
-        # patch = chart[ty0:ty1, tx0:tx1]
-        # ret, patch = cv2.threshold(patch, 0, 255,
-        #                            cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)
-        # label[ty0:ty1, tx0:tx1] = patch
+    boxes = np.asarray([text['TextBB'] for text in texts], float) * factor
+    boxes -= np.tile(np.asarray(description['ImageBB'][:2], float) * factor, 2)
+    boxes *= [sx, sy, sx, sy]
+    boxes[:, :2] = np.floor(boxes[:, :2])
+    boxes[:, 2:] = np.ceil(boxes[:, 2:])
+    boxes = boxes.astype(int)
 
-        # label a box around the text
-        cv2.rectangle(label, (tx0, ty0), (tx1, ty1), WHITE, cv2.cv.CV_FILLED)
+    x0 = np.minimum(boxes[:, 0], boxes[:, 2])
+    x1 = np.maximum(boxes[:, 0], boxes[:, 2])
+    y0 = np.minimum(boxes[:, 1], boxes[:, 3])
+    y1 = np.maximum(boxes[:, 1], boxes[:, 3])
 
-    # dilate the label slightly
-    kernel = np.ones((2, 2), np.uint8)
-    label = cv2.dilate(label, kernel, iterations=2)
+    # like fill_boxes, boxes outside of the figure are not grown into it
+    inside = (x1 >= 0) & (y1 >= 0) & (x0 < width) & (y0 < height)
+    grown = np.column_stack([
+        x0, y0, x1 + int(round(grow*sx)), y1 + int(round(grow*sy))])[inside]
 
-    cv2.imwrite(target, label)
+    return fill_boxes(grown, (height, width), 0)
+
+
+def gen_labels(descriptions):
+    """Returns the labels for all figures of a document (None for figures
+    without text). The text boxes of all figures are converted in one go.
+    """
+
+    counts = [len(d['ImageText']) for d in descriptions]
+    if sum(counts) == 0:
+        return [None] * len(descriptions)
+
+    boxes = _pixel_boxes(
+        [t['TextBB'] for d in descriptions for t in d['ImageText']],
+        np.repeat([d['ImageBB'][:2] for d in descriptions], counts, axis=0))
+
+    labels = []
+    start = 0
+    for description, count in zip(descriptions, counts):
+        if count == 0:
+            labels.append(None)
+        else:
+            labels.append(fill_boxes(boxes[start:start + count],
+                                     label_shape(description)))
+        start += count
+    return labels
+
+
+def encode_label(description, name):
+    """Returns a compact record of the label for a figure: the text boxes
+    (in pixels, inclusive) and how much they are grown by the dilation.
+    Returns None if the figure does not have text.
+    """
+
+    if len(description['ImageText']) == 0:
+        return None
+
+    h, w = label_shape(description)
+    boxes = text_boxes(description)
+
+    # boxes outside of the figure are not part of the label
+    inside = ((np.maximum(boxes[:, 0], boxes[:, 2]) >= 0) &
+              (np.maximum(boxes[:, 1], boxes[:, 3]) >= 0) &
+              (np.minimum(boxes[:, 0], boxes[:, 2]) < w) &
+              (np.minimum(boxes[:, 1], boxes[:, 3]) < h))
+
+    return {
+        'name': name,
+        'shape': [h, w],
+        'grow': DILATION,
+        'boxes': boxes[inside].tolist(),
+    }
+
+
+def decode_label(record, shape=None):
+    """Materializes the mask of a label record at the given (height, width)
+    or at its original size. When scaling, a pixel is part of the label if
+    its center is inside a (grown) box, like a nearest neighbor resize.
+    """
+
+    h, w = record['shape']
+    boxes = np.array(record['boxes'], int).reshape(-1, 4)
+    grow = record['grow']
+
+    if shape is None or tuple(shape) == (h, w):
+        return fill_boxes(boxes, (h, w), grow)
+
+    height, width = shape
+    sx = 1.0*width/w
+    sy = 1.0*height/h
+
+    # covered area at the original size with exclusive ends
+    x0 = np.clip(np.minimum(boxes[:, 0], boxes[:, 2]), 0, w)
+    y0 = np.clip(np.minimum(boxes[:, 1], boxes[:, 3]), 0, h)
+    x1 = np.clip(np.maximum(boxes[:, 0], boxes[:, 2]) + grow + 1, 0, w)
+    y1 = np.clip(np.maximum(boxes[:, 1], boxes[:, 3]) + grow + 1, 0, h)
+
+    # pixels whose centers are inside, inclusive ends
+    scaled = np.column_stack([
+        np.ceil(x0*sx - 0.5), np.ceil(y0*sy - 0.5),
+        np.ceil(x1*sx - 0.5) - 1, np.ceil(y1*sy - 0.5) - 1]).astype(int)
+    scaled = scaled[(scaled[:, 2] >= scaled[:, 0]) &
+                    (scaled[:, 3] >= scaled[:, 1])]
+
+    return fill_boxes(scaled, (height, width), 0)
+
+
+def read_labels(filename):
+    """Reads the label records from a file with one JSON record per line.
+    Returns a dict from figure names to records.
+    """
+    labels = {}
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                labels[record['name']] = record
+    return labels
+
+
+def gen_labeled_image(description, image, target, dbg_output=None, debug=False,
+                      label_format='png', name=None):
+    """Writes the label for a chart to target. The chart image (a path or
+    a numpy array) is only used for the debug output.
+
+    With the png format, target is the image file of the label. With the
+    boxes format, a compact record of the label (see encode_label) with
+    the given name is appended to target, which can be shared by many
+    figures, and the mask is only drawn for the debug output.
+    """
+
+    if len(description['ImageText']) == 0:
+        logging.debug('No text boxes in chart, not labeling it.')
+        return False
+
+    # the boxes format does not need the mask, only the debug output does
+    label = None
+    if label_format != 'boxes' or dbg_output:
+        with metrics.timer('label'):
+            label = gen_label(description)
+
+    if label_format == 'boxes':
+        with metrics.timer('label'):
+            record = encode_label(description, name)
+        with open(target, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    else:
+        with metrics.timer('encode_png', output='label'):
+            cv2.imwrite(target, label)
 
     if dbg_output:
+        chart = load_chart(image)
+
         # convert back to rgb
         label = cv2.cvtColor(label, cv2.COLOR_GRAY2RGB)
         chart = cv2.cvtColor(chart, cv2.COLOR_GRAY2RGB)
@@ -0,0 +1,101 @@
+"""Manifests that record how the outputs of a document were produced.
+
+The outputs of a document are produced in stages (see STAGES). For every
+stage, the manifest records its parameters (including the hashes of the
+inputs and the versions of the tools) and the names of the files it wrote.
+If a document is processed again with the same parameters, the stage can
+be skipped and its outputs reused.
+
+The parameters of a stage include the hash of the parameters of the
+previous stage, so changing an early stage invalidates all later stages.
+"""
+
+import os
+import json
+import hashlib
+
+
+STAGES = ['figures', 'render', 'labels']
+
+# hashes of tools, by path and modification time
+_hashes = {}
+
+
+def file_hash(filename):
+    """SHA1 of the contents of a file."""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def tool_hash(filename):
+    """Like file_hash, but the hash is only computed once per process
+    unless the file changes.
+    """
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    if key not in _hashes:
+        _hashes[key] = file_hash(filename)
+    return _hashes[key]
+
+
+def params_hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+
+class Manifest(object):
+    """The manifest of one document, stored as JSON in filename."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stages = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.stages = json.load(f).get('stages', {})
+
+    def current_stages(self, params, directories=None):
+        """Returns the stages that were run with the same parameters. If
+        directories (stage to directory) are given, all outputs of the
+        stages must still exist. A stage is only current if all previous
+        stages are current.
+        """
+
+        current = set()
+        for stage in STAGES:
+            recorded = self.stages.get(stage)
+            if not recorded or recorded['params'] != _normalize(params[stage]):
+                break
+            if directories is not None and not all(
+                    os.path.exists(os.path.join(directories[stage], name))
+                    for name in recorded['outputs']):
+                break
+            current.add(stage)
+        return current
+
+    def outputs(self, stage):
+        """Names of the files that a stage wrote."""
+        return self.stages[stage]['outputs']
+
+    def get(self, stage, name, default=None):
+        return self.stages.get(stage, {}).get(name, default)
+
+    def record(self, stage, params, outputs, **extra):
+        """Records that the stage wrote the output files. Extra values are
+        stored with the stage.
+        """
+        self.stages[stage] = dict(extra, params=_normalize(params),
+                                  outputs=[os.path.basename(f) for f in outputs])
+
+    def save(self):
+        # replace atomically so that a crash never leaves half a manifest
+        tmp_file = self.filename + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'stages': self.stages}, f, indent=2, sort_keys=True)
+        os.rename(tmp_file, self.filename)
+
+
+def _normalize(params):
+    # compare parameters the way they are stored (e.g. tuples as lists)
+    return json.loads(json.dumps(params))
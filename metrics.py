@@ -0,0 +1,211 @@
+"""Timers and counters for the stages of the pipeline.
+
+Every process collects its own metrics:
+
+  with metrics.timer('render', dpi=200):
+      ...
+  metrics.count('figures', 3, state='labeled')
+
+A timer adds the wall time and the CPU time of the calling thread to the
+totals of the stage (and labels). Work in subprocesses (pdffigures) only
+counts as wall time. On Python 2 (time.clock), the CPU time is the one of
+the whole process, so timers of concurrent threads include each other's
+work. Counters add up values.
+
+Nothing is written unless metrics.configure is called with an output
+prefix. Then every process writes to its own file PREFIX-HOST-PID.jsonl or
+PREFIX-HOST-PID.prom when metrics.flush is called. The json format appends
+one line with the metrics since the last flush (e.g. of one document). The
+prometheus format rewrites the file with the totals in the text format
+that the Prometheus node exporter reads (textfile collector).
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+import contextlib
+
+
+FORMATS = {'json': 'jsonl', 'prometheus': 'prom'}
+
+NAMESPACE = 'label_generator'
+
+# CPU time of the calling thread, if the platform can measure it, otherwise
+# of the process
+_cpu_time = (getattr(time, 'thread_time', None) or
+             getattr(time, 'process_time', None) or time.clock)
+
+_lock = threading.Lock()
+_settings = {}
+
+# (name, labels) to [calls, wall seconds, cpu seconds]
+_timers = {}
+# (name, labels) to value
+_counters = {}
+# the values at the last flush
+_flushed = ({}, {})
+
+
+def configure(prefix, fmt='json'):
+    """Writes the metrics of this process to files starting with prefix in
+    the format (json or prometheus).
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown metrics format {}. Use one of {}.'.format(
+            fmt, ', '.join(sorted(FORMATS))))
+    directory = os.path.dirname(prefix)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    _settings['prefix'] = prefix
+    _settings['format'] = fmt
+
+
+def settings():
+    """Returns the prefix and the format, e.g. to configure workers the
+    same way, or None if nothing is written.
+    """
+    if not _settings:
+        return None
+    return _settings['prefix'], _settings['format']
+
+
+def reset():
+    """Forgets all metrics, e.g. the ones a worker inherited from its
+    parent process.
+    """
+    global _flushed
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _flushed = ({}, {})
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def add_time(name, wall, cpu=None, **labels):
+    """Adds a measured time to the totals of a stage."""
+    key = _key(name, labels)
+    with _lock:
+        totals = _timers.setdefault(key, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += wall
+        totals[2] += cpu or 0.0
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """Measures the wall and CPU time of the block."""
+    wall = time.time()
+    cpu = _cpu_time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - wall, _cpu_time() - cpu, **labels)
+
+
+def count(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def _filename():
+    # the pid is looked up when writing so that every worker gets a file
+    return '{}-{}-{}.{}'.format(_settings['prefix'], socket.gethostname(),
+                                os.getpid(), FORMATS[_settings['format']])
+
+
+def _json_record(timers, counters, fields):
+    record = dict(fields, time=time.time(), host=socket.gethostname(),
+                  pid=os.getpid())
+    record['timers'] = [
+        dict(labels, name=name, calls=calls,
+             wall=round(wall, 6), cpu=round(cpu, 6))
+        for (name, labels), (calls, wall, cpu) in sorted(timers.items())]
+    record['counters'] = [
+        dict(labels, name=name, value=value)
+        for (name, labels), value in sorted(counters.items())]
+    return record
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels))
+
+
+def prometheus_text(timers, counters):
+    """Returns the metrics in the Prometheus text format."""
+    lines = []
+
+    def metric(name, help_text, samples):
+        name = '{}_{}'.format(NAMESPACE, name)
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} counter'.format(name))
+        for labels, value in samples:
+            lines.append('{}{} {}'.format(name, _prometheus_labels(labels),
+                                          value))
+
+    stages = sorted(timers.items())
+    stage_labels = [(('stage', name),) + labels for (name, labels), _ in stages]
+    metric('stage_calls_total', 'Number of times a stage ran.',
+           [(l, t[0]) for l, (_, t) in zip(stage_labels, stages)])
+    metric('stage_wall_seconds_total', 'Wall time spent in a stage.',
+           [(l, repr(t[1])) for l, (_, t) in zip(stage_labels, stages)])
+    metric('stage_cpu_seconds_total', 'CPU time spent in a stage.',
+           [(l, repr(t[2])) for l, (_, t) in zip(stage_labels, stages)])
+
+    names = sorted(set(name for name, _ in counters))
+    for name in names:
+        metric('{}_total'.format(name), 'Number of {}.'.format(
+            name.replace('_', ' ')), [(labels, value) for (n, labels), value
+                                      in sorted(counters.items()) if n == name])
+
+    return '\n'.join(lines) + '\n'
+
+
+def flush(**fields):
+    """Writes the metrics if an output is configured. The fields (e.g. the
+    name of a document) are added to json records. Nothing is appended if
+    nothing happened since the last flush.
+    """
+    global _flushed
+
+    if not _settings:
+        return
+
+    with _lock:
+        timers = dict((k, list(v)) for k, v in _timers.items())
+        counters = dict(_counters)
+        last_timers, last_counters = _flushed
+        _flushed = (timers, counters)
+
+    filename = _filename()
+    if _settings['format'] == 'json':
+        # only what happened since the last flush
+        new_timers = {}
+        for key, totals in timers.items():
+            last = last_timers.get(key, [0, 0.0, 0.0])
+            if totals[0] != last[0]:
+                new_timers[key] = [t - l for t, l in zip(totals, last)]
+        new_counters = dict(
+            (key, value - last_counters.get(key, 0))
+            for key, value in counters.items()
+            if value != last_counters.get(key, 0))
+        if not new_timers and not new_counters:
+            return
+        with open(filename, 'a') as f:
+            f.write(json.dumps(_json_record(
+                new_timers, new_counters, fields)) + '\n')
+    else:
+        # replace atomically so that the collector never reads half a file
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(prometheus_text(timers, counters))
+        os.rename(tmp_file, filename)
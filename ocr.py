@@ -0,0 +1,206 @@
+"""Read text in patches of an image with tesseract.
+
+There are two backends. tesserocr keeps one tesseract engine per process
+and reads the patches without starting any processes. tesseract (with
+pytesseract) stacks the patches of an image into a few tall images and
+runs the tesseract command once for each of them. auto uses tesserocr if
+it is installed.
+
+Patches are first read as they are. Only patches that are read with a low
+confidence are rotated by 90 degrees and read again (up to three times).
+"""
+
+import os
+
+import numpy as np
+import cv2
+
+
+# patches read with a lower mean confidence (0-100) are tried rotated
+MIN_CONFIDENCE = 60
+
+# tesseract cannot read text in smaller patches
+MIN_SIZE = 6
+
+# white rows between stacked patches
+GAP = 16
+
+# maximum height of a stacked image, tesseract supports up to 32767 pixels
+MAX_HEIGHT = 16000
+
+WHITE = 255
+
+
+def to_gray(patch):
+    if patch.ndim == 3:
+        return cv2.cvtColor(patch, cv2.COLOR_BGR2GRAY)
+    return patch
+
+
+def rotate(patch):
+    """Rotates a patch by 90 degrees counterclockwise."""
+    return cv2.flip(cv2.transpose(patch), 0)
+
+
+class TesserocrReader(object):
+    """Reads patches one by one with a tesseract engine in this process."""
+
+    def __init__(self):
+        tesserocr = self._import()
+        self._api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_BLOCK)
+
+    @staticmethod
+    def _import():
+        # optional dependency, only needed for this backend
+        import tesserocr
+        return tesserocr
+
+    @classmethod
+    def version(cls):
+        return 'tesserocr {}'.format(cls._import().tesseract_version())
+
+    def read(self, patches):
+        """Returns the text and the mean confidence of every patch."""
+        from PIL import Image
+
+        results = []
+        for patch in patches:
+            self._api.SetImage(Image.fromarray(to_gray(patch)))
+            results.append((self._api.GetUTF8Text().strip(),
+                            self._api.MeanTextConf()))
+        return results
+
+    def close(self):
+        self._api.End()
+
+
+class TesseractReader(object):
+    """Runs the tesseract command on stacks of patches (with pytesseract).
+
+    The words that tesseract finds in a stack are assigned to patches by
+    their vertical position.
+    """
+
+    def __init__(self):
+        self._pytesseract = self._import()
+
+    @staticmethod
+    def _import():
+        # optional dependency, only needed for this backend
+        import pytesseract
+        return pytesseract
+
+    @classmethod
+    def version(cls):
+        return 'tesseract {}'.format(cls._import().get_tesseract_version())
+
+    def _stacks(self, patches):
+        """Groups the patches into stacks of at most MAX_HEIGHT pixels."""
+        stack = []
+        height = 0
+        for i, patch in enumerate(patches):
+            if stack and height + patch.shape[0] + GAP > MAX_HEIGHT:
+                yield stack
+                stack = []
+                height = 0
+            stack.append(i)
+            height += patch.shape[0] + GAP
+        if stack:
+            yield stack
+
+    def _read_stack(self, patches):
+        from PIL import Image
+
+        height = sum(p.shape[0] + GAP for p in patches) + GAP
+        width = max(p.shape[1] for p in patches) + 2 * GAP
+        canvas = np.full((height, width), WHITE, np.uint8)
+
+        tops = []
+        y = GAP
+        for patch in patches:
+            h, w = patch.shape[:2]
+            canvas[y:y + h, GAP:GAP + w] = to_gray(patch)
+            tops.append(y)
+            y += h + GAP
+
+        data = self._pytesseract.image_to_data(
+            Image.fromarray(canvas), config='--psm 6',
+            output_type=self._pytesseract.Output.DICT)
+
+        words = [[] for _ in patches]
+        confidences = [[] for _ in patches]
+        for text, conf, top, h in zip(data['text'], data['conf'],
+                                      data['top'], data['height']):
+            conf = float(conf)
+            if conf < 0 or not text.strip():
+                continue
+            i = np.searchsorted(tops, top + h / 2.0, 'right') - 1
+            i = min(max(i, 0), len(patches) - 1)
+            words[i].append(text.strip())
+            confidences[i].append(conf)
+
+        return [(' '.join(w), np.mean(c) if c else 0)
+                for w, c in zip(words, confidences)]
+
+    def read(self, patches):
+        """Returns the text and the mean confidence of every patch."""
+        results = [None] * len(patches)
+        for stack in self._stacks(patches):
+            for i, result in zip(stack, self._read_stack(
+                    [patches[i] for i in stack])):
+                results[i] = result
+        return results
+
+    def close(self):
+        pass
+
+
+READERS = {
+    'tesserocr': TesserocrReader,
+    'tesseract': TesseractReader,
+}
+
+
+def get_reader(name='auto'):
+    """Creates the OCR backend with the given name."""
+
+    # tesseract starts several threads per process by default, which only
+    # competes with the other worker processes
+    os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+    if name == 'auto':
+        try:
+            return TesserocrReader()
+        except ImportError:
+            return TesseractReader()
+    if name not in READERS:
+        raise ValueError('Unknown OCR backend {}. Use one of auto, {}.'.format(
+            name, ', '.join(sorted(READERS))))
+    return READERS[name]()
+
+
+def read_text(reader, patches):
+    """Reads the text in the patches with a reader. Patches that are read
+    with a low confidence are rotated and read again.
+
+    Returns the text, the confidence and the number of counterclockwise
+    quarter turns of the best reading of every patch.
+    """
+
+    patches = list(patches)
+    results = [('', 0, 0)] * len(patches)
+    pending = [i for i, p in enumerate(patches) if min(p.shape[:2]) >= MIN_SIZE]
+
+    for turns in range(4):
+        if not pending:
+            break
+        readings = reader.read([patches[i] for i in pending])
+        for i, (text, conf) in zip(pending, readings):
+            if text and conf > results[i][1]:
+                results[i] = (text, conf, turns)
+
+        pending = [i for i in pending if results[i][1] < MIN_CONFIDENCE]
+        for i in pending:
+            patches[i] = rotate(patches[i])
+
+    return results
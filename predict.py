@@ -1,25 +1,58 @@
 """Finds and reads text in an image.
 
+The batch command finds the text in many images with a pool of worker
+processes. LIST is a directory with predictions (NAME-predicted.png next to
+NAME.png) or a file with one prediction per line, optionally followed by
+the image (relative paths are relative to the file). For every image, the
+rotated boxes around text are written to OUTPUT/NAME-text.json in the format
+of the figures of pdffigures (ImageBB and ImageText with TextBB and
+Rotation), so that label_image.py can read them.
+
+With --ocr, the text in the boxes is read with tesseract (see ocr.py for the
+backends) and added to the boxes (Text and Confidence). The version of the
+OCR engine is recorded in the JSON (OCR).
+
+The mask is scaled to the size of the image and searched for text in tiles
+of --tile-size pixels, so that the scaled mask and the contour search never
+need more than one tile. The mask itself (at its own size) is still read in
+full, and so is the image for OCR and debug output. Boxes that cross the
+edges of tiles are merged.
+
 Usage:
-  predict.py TEXT_MASK IMAGE [--thresh=THRESH] [--debug]
+  predict.py TEXT_MASK IMAGE [--thresh=THRESH] [--ocr=BACKEND] [--tile-size=N] [--debug]
+  predict.py batch LIST OUTPUT [--thresh=THRESH] [--ocr=BACKEND] [--tile-size=N] [--workers=N] [--chunk-size=N] [--debug]
   predict.py (-h | --help)
   predict.py --version
 
 Options:
   --thresh=THRESH   Threshold for mask image [default: 200].
+  --ocr=BACKEND     Read the text with tesseract. auto uses tesserocr if it
+                    is installed and the tesseract command otherwise.
+  --tile-size=N     Size of the tiles to find text in. Use 0 to find text in
+                    the whole image at once [default: 4096].
+  --workers=N       Number of worker processes (default: number of cores).
+  --chunk-size=N    Number of images to send to a worker at once
+                    [default: 16].
   --debug           Write debug output.
   -h --help         Show this screen.
   --version         Show version.
 """
 
+import os
+import sys
+import json
+import glob
+import time
 import logging
 import copy
 
 import numpy as np
 import cv2
 from docopt import docopt
-import pytesseract
 from PIL import Image
+
+import ocr
+import workerpool
 # from skimage.restoration import denoise_tv_chambolle
 
 
@@ -30,10 +63,23 @@ BLACK = (0, 0, 0)
 
 DEBUG = False
 
+# add borders to the mask so that text at the edges has closed contours
+BORDER = 12
+
+# increase size of rects
+GROW = 1.1
+
+# how large should the snap of rotations to multiples of 90 degrees be
+EPSYLON = 5
+
+# neighboring tiles overlap, so that text that crosses the edge of a tile
+# is found in both
+OVERLAP = 16
 
-def cvToPIL(image):
-    cv2_im = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    return Image.fromarray(cv2_im)
+PREDICTION_SUFFIX = '-predicted.png'
+
+# state of a batch worker process, set up once by _init_worker
+_worker = {}
 
 
 def subimage(image, center, theta, width, height):
@@ -52,16 +98,23 @@ def subimage(image, center, theta, width, height):
                           borderMode=cv2.BORDER_REPLICATE)
 
 
-def predict_text(mask, image, thresh):
-    mask = cv2.imread(mask, cv2.CV_LOAD_IMAGE_GRAYSCALE)
-    image = cv2.imread(image)
+def find_rects(mask, shape, thresh, tile_size=None):
+    """Finds the text in a predicted mask (gray) for an image of the given
+    shape. Returns the rotated rectangles around the text as an (N, 5) array
+    of center x, center y, width, height and angle (in degrees) in the
+    coordinates of the image.
+
+    If the image (with borders) is larger than tile_size, the text is found
+    in tiles (see find_rects_tiled).
+    """
+
+    h, w = shape[:2]
+    if tile_size and max(h, w) + 2 * BORDER > tile_size:
+        return _adjust(find_rects_tiled(mask, shape, thresh, tile_size))
 
-    h, w, _ = image.shape
     mask = cv2.resize(mask, (w, h))
 
-    # add borders
-    b = 12
-    image = cv2.copyMakeBorder(image, b, b, b, b, cv2.BORDER_REPLICATE)
+    b = BORDER
     mask = cv2.copyMakeBorder(mask, b, b, b, b,
                               cv2.BORDER_CONSTANT, value=BLACK)
 
@@ -75,11 +128,8 @@ def predict_text(mask, image, thresh):
     # mask = np.array(mask*255, np.uint8)
 
     if DEBUG:
-        dbg_img = copy.copy(image)
         cv2.imshow('mask', mask)
 
-    # print pytesseract.image_to_string(cvToPIL(image), config='-psm 3')
-
     # threshold the prediction
     _, thresh = cv2.threshold(mask, thresh, 255, cv2.THRESH_BINARY)
 
@@ -100,51 +150,306 @@ def predict_text(mask, image, thresh):
                                            cv2.cv.CV_RETR_LIST,
                                            cv2.cv.CV_CHAIN_APPROX_SIMPLE)
 
-    for contour in contours:
-        # box = cv2.boundingRect(contour)
-        # x, y, w, h = scale*np.array(box)
-        # cv2.rectangle(image, (int(x), int(y)), (int(x+w), int(y+h)), RED, 3)
-
-        rect = cv2.minAreaRect(contour)
+    rects = np.array([(cx, cy, rw, rh, theta) for (cx, cy), (rw, rh), theta
+                      in map(cv2.minAreaRect, contours)], float).reshape(-1, 5)
+
+    # undo the border
+    rects[:, :2] -= b
+
+    return _adjust(rects)
+
+
+def _adjust(rects):
+    rects[:, 2:4] *= GROW
+
+    # snap rotation
+    snapped = np.round(rects[:, 4] / 90) * 90
+    near = np.abs(rects[:, 4] - snapped) <= EPSYLON
+    rects[near, 4] = snapped[near]
+
+    return rects
+
+
+def _union_find(pairs, n):
+    """Returns the group of each of n items given pairs of items in the
+    same group.
+    """
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        parent[find(i)] = find(j)
+    return [find(i) for i in range(n)]
+
+
+def _pieces_touch(a, b):
+    """Tests whether two contours (as points) share pixels by drawing them
+    where their bounding boxes intersect.
+    """
+    x0, y0 = np.maximum(a.min(axis=0), b.min(axis=0))
+    x1, y1 = np.minimum(a.max(axis=0), b.max(axis=0))
+    if x0 > x1 or y0 > y1:
+        return False
+
+    shape = (y1 - y0 + 1, x1 - x0 + 1)
+    first = np.zeros(shape, np.uint8)
+    second = np.zeros(shape, np.uint8)
+    cv2.drawContours(first, [a - (x0, y0)], 0, 255, cv2.cv.CV_FILLED)
+    cv2.drawContours(second, [b - (x0, y0)], 0, 255, cv2.cv.CV_FILLED)
+    return np.logical_and(first, second).any()
+
+
+def _overlapping(first, second, bounds, axis):
+    """Yields the pairs of pieces from first and second whose bounds
+    (x0, y0, x1, y1) intersect, with a sweep along axis (0 is x).
+    """
+    events = sorted([(bounds[i][axis], 0, i) for i in first] +
+                    [(bounds[j][axis], 1, j) for j in second])
+    active = ([], [])
+    other_axis = 1 - axis
+    for start, side, i in events:
+        box = bounds[i]
+        others = [j for j in active[1 - side] if bounds[j][axis + 2] > start]
+        active[1 - side][:] = others
+        for j in others:
+            if (box[other_axis] < bounds[j][other_axis + 2] and
+                    bounds[j][other_axis] < box[other_axis + 2]):
+                yield (i, j) if side == 0 else (j, i)
+        active[side].append(i)
+
+
+def find_rects_tiled(mask, shape, thresh, tile_size):
+    """Like find_rects but the mask is scaled, thresholded and searched for
+    contours one tile at a time. Contours that reach into the overlap with a
+    neighboring tile may continue there. They are merged with the contours
+    (outlines with outlines and holes with holes) of the other tiles that
+    they share pixels with and the rectangle is fitted to the merged points.
+    Only the pieces in neighboring tiles are compared, so the merge does not
+    grow with the square of the pieces. The mask is passed in whole.
+    Returns the rectangles before they are grown and snapped.
+    """
+
+    h, w = shape[:2]
+    mh, mw = mask.shape[:2]
+    sx = mw / float(w)
+    sy = mh / float(h)
+
+    # tiles cover the image and its border
+    b = BORDER
+    step = tile_size - OVERLAP
+    rects = []
+    pieces = []
+    for ty in range(-b, h + b - OVERLAP, step):
+        for tx in range(-b, w + b - OVERLAP, step):
+            th = min(tile_size, h + b - ty)
+            tw = min(tile_size, w + b - tx)
+
+            # the same mapping as resizing the whole mask, but the
+            # interpolation is rounded differently
+            mapping = np.array([[sx, 0, (tx + 0.5) * sx - 0.5],
+                                [0, sy, (ty + 0.5) * sy - 0.5]])
+            tile = cv2.warpAffine(mask, mapping, (tw, th),
+                                  flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                  borderMode=cv2.BORDER_REPLICATE)
+
+            # black border around the image
+            tile[:max(-ty, 0)] = 0
+            tile[max(h - ty, 0):] = 0
+            tile[:, :max(-tx, 0)] = 0
+            tile[:, max(w - tx, 0):] = 0
+
+            _, tile = cv2.threshold(tile, thresh, 255, cv2.THRESH_BINARY)
+
+            # like CV_RETR_LIST but holes can be told apart
+            contours, hierarchy = cv2.findContours(
+                tile, cv2.RETR_CCOMP, cv2.cv.CV_CHAIN_APPROX_SIMPLE)
+            if not contours:
+                continue
+
+            for contour, (_, _, _, parent) in zip(contours, hierarchy[0]):
+                x, y, cw, ch = cv2.boundingRect(contour)
+                overlaps = (
+                    (tx > -b and x < OVERLAP) or
+                    (ty > -b and y < OVERLAP) or
+                    (tx + tw < w + b and x + cw > tw - OVERLAP) or
+                    (ty + th < h + b and y + ch > th - OVERLAP))
+                if overlaps:
+                    pieces.append((contour.reshape(-1, 2) + (tx, ty),
+                                   (tx, ty, parent >= 0),
+                                   (x + tx, y + ty, x + tx + cw, y + ty + ch)))
+                else:
+                    (cx, cy), (rw, rh), theta = cv2.minAreaRect(contour)
+                    rects.append((cx + tx, cy + ty, rw, rh, theta))
+
+    if pieces:
+        # pieces of the same text (or hole) in different tiles share the
+        # pixels in the overlap of neighboring tiles
+        by_tile = {}
+        for i, (_, tile, _) in enumerate(pieces):
+            by_tile.setdefault(tile, []).append(i)
+
+        pairs = []
+        for (tx, ty, hole), first in by_tile.items():
+            # every pair of neighbors once, swept along their seam
+            for dx, dy, axis in [(step, 0, 1), (0, step, 0),
+                                 (step, step, 0), (-step, step, 0)]:
+                second = by_tile.get((tx + dx, ty + dy, hole))
+                if not second:
+                    continue
+                for i, j in _overlapping(first, second,
+                                         [bbox for _, _, bbox in pieces],
+                                         axis):
+                    if _pieces_touch(pieces[i][0], pieces[j][0]):
+                        pairs.append((i, j))
+        groups = _union_find(pairs, len(pieces))
+
+        points = {}
+        for group, (piece_points, _, _) in zip(groups, pieces):
+            points.setdefault(group, []).append(piece_points)
+        for group in sorted(points):
+            (cx, cy), (rw, rh), theta = cv2.minAreaRect(
+                np.concatenate(points[group]).astype(np.int32))
+            rects.append((cx, cy, rw, rh, theta))
+
+    return np.array(rects, float).reshape(-1, 5)
+
+
+def box_points(rects):
+    """Returns the corners of rotated rectangles (see find_rects) as an
+    (N, 4, 2) array in the same order as cv2.boxPoints.
+    """
+
+    theta = rects[:, 4] * np.pi / 180
+    b = np.cos(theta) * 0.5
+    a = np.sin(theta) * 0.5
+    cx, cy, w, h = rects[:, 0], rects[:, 1], rects[:, 2], rects[:, 3]
+
+    points = np.empty((len(rects), 4, 2))
+    points[:, 0, 0] = cx - a * h - b * w
+    points[:, 0, 1] = cy + b * h - a * w
+    points[:, 1, 0] = cx + a * h - b * w
+    points[:, 1, 1] = cy - b * h - a * w
+    points[:, 2] = 2 * rects[:, :2] - points[:, 0]
+    points[:, 3] = 2 * rects[:, :2] - points[:, 1]
+    return points
+
+
+def read_rects(image, rects, reader):
+    """Reads the text in the rotated rectangles of an image with an OCR
+    reader (see ocr.read_text).
+    """
+    image = ocr.to_gray(image)
+    patches = [subimage(image, (cx, cy), theta, w, h)
+               if min(w, h) >= ocr.MIN_SIZE else np.zeros((0, 0), np.uint8)
+               for cx, cy, w, h, theta in rects]
+    return ocr.read_text(reader, patches)
+
+
+def describe(rects, shape, name, texts=None, ocr_version=None):
+    """Describes the text in an image like pdffigures describes a figure.
+    TextBB is the bounding box of a rotated rectangle (clipped to the image)
+    and Box its corners. Rotation is the number of clockwise quarter turns
+    of the text, along the longer side of the rectangle unless the text was
+    read in another direction. If the text was read (see read_rects), it is
+    added with its confidence and the version of the OCR engine.
+    """
+
+    h, w = shape[:2]
+    points = box_points(rects)
+    lower = np.maximum(points.min(axis=1), 0)
+    upper = np.minimum(points.max(axis=1), [w, h])
+
+    # the text runs along the longer side, unless it was read in another
+    # direction (counterclockwise quarter turns of the patch)
+    if texts is not None:
+        turns = np.array([t[2] for t in texts], int).reshape(-1)
+    else:
+        turns = np.where(rects[:, 3] > rects[:, 2], 1, 0)
+    angles = rects[:, 4] + 90 * turns
+    # clockwise quarter turns of the text in the image
+    rotations = np.round(angles / 90).astype(int) % 4
+
+    boxes = []
+    for i in range(len(rects)):
+        box = {
+            'TextBB': [round(v, 2) for v in np.concatenate([lower[i], upper[i]])],
+            'Box': np.round(points[i], 2).tolist(),
+            'Angle': round(rects[i, 4], 2),
+            'Rotation': int(rotations[i]),
+        }
+        if texts is not None:
+            text, confidence, _ = texts[i]
+            box['Text'] = text
+            box['Confidence'] = round(float(confidence), 1)
+        boxes.append(box)
+
+    description = {
+        'Image': name,
+        'ImageBB': [0, 0, w, h],
+        'ImageText': boxes,
+    }
+    if ocr_version:
+        description['OCR'] = ocr_version
+    return description
+
+
+def image_shape(image_file):
+    """Returns the height and width of an image without decoding it."""
+    width, height = Image.open(image_file).size
+    return height, width
+
+
+def predict_text(mask, image, thresh, ocr_backend=None, tile_size=None):
+    mask = cv2.imread(mask, cv2.CV_LOAD_IMAGE_GRAYSCALE)
 
-        # increase size of rect
-        dims = rect[1]
-        dims = (dims[0]*1.1, dims[1]*1.1)
+    rects = find_rects(mask, image_shape(image), thresh, tile_size)
+    print("Found {} boxes".format(len(rects)))
 
-        # snap rotation
-        angles = [-360, -270, -180, -90, 0, 90, 180, 270, 360]
-        theta = rect[2]
-        epsylon = 5  # how large should the snap be
-        for a in angles:
-            if a-epsylon <= theta <= a+epsylon:
-                theta = a
+    if not (DEBUG or ocr_backend):
+        return
 
-        rect = rect[0], dims, theta
+    image = cv2.imread(image)
 
-        if DEBUG:
-            box = cv2.cv.BoxPoints(rect)
-            box_np = np.int0(box)
-            cv2.drawContours(dbg_img, [box_np], 0, (0, 0, 255), 2)
+    # add borders
+    b = BORDER
+    image = cv2.copyMakeBorder(image, b, b, b, b, cv2.BORDER_REPLICATE)
+    rects[:, :2] += b
 
-        # skip OCR
-        continue
+    if DEBUG:
+        dbg_img = copy.copy(image)
 
-        center, (w, h), theta = rect
-        patch = subimage(image, center, theta, w, h)
+    texts = None
+    if ocr_backend:
+        reader = ocr.get_reader(ocr_backend)
+        logging.debug('Reading the text with {}'.format(reader.version()))
+        texts = read_rects(image, rects, reader)
+        reader.close()
 
-        for x in range(4):
-            text = pytesseract.image_to_string(cvToPIL(patch))
+    for i, box in enumerate(box_points(rects)):
+        # box = cv2.boundingRect(contour)
+        # x, y, w, h = scale*np.array(box)
+        # cv2.rectangle(image, (int(x), int(y)), (int(x+w), int(y+h)), RED, 3)
 
-            cv2.putText(dbg_img, text, (int(center[0]), int(10+center[1] + 7*x)), cv2.FONT_HERSHEY_COMPLEX_SMALL, 0.6, BLUE)
-            print(text)
+        if DEBUG:
+            box_np = np.int0(box)
+            cv2.drawContours(dbg_img, [box_np], 0, (0, 0, 255), 2)
 
-            # cv2.imshow('patch', patch)
-            # cv2.waitKey(0)
+        if texts is None:
+            continue
 
-            patch = cv2.transpose(patch)
-            patch = cv2.flip(patch, 0)
+        text, confidence, turns = texts[i]
+        if not text:
+            continue
 
-        print("======")
+        center = rects[i, :2]
+        if DEBUG:
+            cv2.putText(dbg_img, text, (int(center[0]), int(10+center[1])), cv2.FONT_HERSHEY_COMPLEX_SMALL, 0.6, BLUE)
+        print("{} ({:.0f}, rotated {} times)".format(text, confidence, turns))
 
     if DEBUG:
         cv2.imshow('image', dbg_img)
@@ -153,6 +458,107 @@ def predict_text(mask, image, thresh):
         cv2.destroyAllWindows()
 
 
+def find_pairs(path):
+    """Returns the (prediction, image) pairs in a directory or list file."""
+
+    if os.path.isdir(path):
+        predictions = sorted(glob.glob(os.path.join(
+            path, '*' + PREDICTION_SUFFIX)))
+        return [(p, p[:-len(PREDICTION_SUFFIX)] + '.png') for p in predictions]
+
+    where = os.path.dirname(path)
+    pairs = []
+    with open(path) as f:
+        for line in f:
+            files = [os.path.join(where, p) for p in line.split()]
+            if not files:
+                continue
+            if len(files) == 1:
+                files.append(files[0][:-len(PREDICTION_SUFFIX)] + '.png')
+            pairs.append(tuple(files[:2]))
+    return pairs
+
+
+def _init_worker(settings):
+    _worker.update(settings)
+    # one OCR engine per worker, so at most one tesseract per worker runs
+    backend = settings['ocr_backend']
+    _worker['reader'] = ocr.get_reader(backend) if backend else None
+    _worker['ocr_version'] = _worker['reader'].version() if backend else None
+
+
+def _detect(pair):
+    """Finds the text of one pair in a batch worker and writes it to the
+    output directory. Returns the name, the number of boxes and an error
+    message if the pair could not be processed.
+    """
+
+    mask_file, image_file = pair
+    name = os.path.splitext(os.path.basename(image_file))[0]
+
+    mask = cv2.imread(mask_file, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+    if mask is None:
+        return name, 0, 'Could not read {}'.format(mask_file)
+
+    try:
+        shape = image_shape(image_file)
+        rects = find_rects(mask, shape, _worker['thresh'],
+                           _worker['tile_size'])
+
+        # the image is only decoded to read the text
+        texts = None
+        if _worker['reader']:
+            texts = read_rects(cv2.imread(image_file), rects,
+                               _worker['reader'])
+        description = describe(rects, shape, os.path.basename(image_file),
+                               texts, _worker['ocr_version'])
+
+        with open(os.path.join(_worker['output'], name + '-text.json'),
+                  'w') as f:
+            json.dump(description, f)
+    except Exception as e:
+        logging.exception('Failed to process {}'.format(image_file))
+        return name, 0, 'Could not process {}: {}'.format(image_file, e)
+
+    return name, len(rects), None
+
+
+def run_batch(path, output, thresh, workers=None, chunk_size=16,
+              ocr_backend=None, tile_size=None):
+    """Finds (and with an OCR backend reads) the text in all pairs of a
+    directory or list file with a pool of workers. Reports the throughput
+    on stderr.
+    """
+
+    pairs = find_pairs(path)
+    if not os.path.exists(output):
+        os.makedirs(output)
+
+    settings = {
+        'output': output,
+        'thresh': thresh,
+        'ocr_backend': ocr_backend,
+        'tile_size': tile_size,
+    }
+    results = workerpool.imap(_detect, pairs, 0 if DEBUG else workers,
+                              _init_worker, (settings,), chunk_size)
+
+    start = time.time()
+    boxes = 0
+    failed = 0
+    try:
+        for i, (name, count, error) in enumerate(results, 1):
+            if error:
+                logging.error(error)
+                failed += 1
+            boxes += count
+            workerpool.progress(i, len(pairs), 'images', start)
+    finally:
+        results.close()
+
+    sys.stderr.write('\nFound {} boxes\n'.format(boxes))
+    workerpool.summary('Processed', len(pairs), 'images', start, failed)
+
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='Predictor 1.0')
 
@@ -160,5 +566,15 @@ if __name__ == '__main__':
         logging.basicConfig(level=logging.DEBUG)
         DEBUG = True
 
-    predict_text(arguments['TEXT_MASK'], arguments['IMAGE'],
-                 int(arguments['--thresh']))
+    if arguments['batch']:
+        workers = None
+        if arguments['--workers']:
+            workers = int(arguments['--workers'])
+        run_batch(arguments['LIST'], arguments['OUTPUT'],
+                  int(arguments['--thresh']), workers,
+                  int(arguments['--chunk-size']), arguments['--ocr'],
+                  int(arguments['--tile-size']))
+    else:
+        predict_text(arguments['TEXT_MASK'], arguments['IMAGE'],
+                     int(arguments['--thresh']), arguments['--ocr'],
+                     int(arguments['--tile-size']))
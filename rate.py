@@ -2,103 +2,389 @@
 
 Provide a list of predicted files. In the same directory should
 also be the label files. This script assumes correct filenames.
+Instead of label images, the labels can also be read from label files
+in the boxes format (see label_gen.py --label-format) or be computed from
+the JSON of the figures (--json), directly at the size of the predictions.
+
+The images are compared by a pool of worker processes. Pass several
+comma separated thresholds (e.g. --thresh=100,150,200) to compare all of
+them in one pass over the images.
+
+For every image, the pixels are counted in histograms of the predicted
+intensity, so that the metrics for any threshold can be computed from them
+without reading the images again. --curve writes the precision and recall
+for all thresholds and --csv the metrics of every image (e.g. to find the
+worst predictions). --histograms saves the histograms of every image, so
+that the metrics can be computed again later with the histograms command.
 
 Usage:
-  main.py LIST [--thresh=THRESH] [--debug]
+  main.py LIST [--thresh=THRESH] [--labels=FILE]... [--json=DIR] [--csv=FILE] [--curve=FILE] [--histograms=FILE] [--workers=N] [--chunk-size=N] [--debug]
+  main.py histograms FILE [--thresh=THRESH] [--csv=FILE] [--curve=FILE]
   main.py (-h | --help)
   main.py --version
 
 Options:
   --thresh=THRESH   Threshold for predicted image [default: 200].
+  --labels=FILE     Read labels from this file in the boxes format.
+  --json=DIR        Compute labels from the JSON of the figures in this
+                    directory (NAME.json).
+  --csv=FILE        Write the metrics of every image and threshold to a
+                    CSV file.
+  --curve=FILE      Write the metrics for all thresholds to a CSV file.
+  --histograms=FILE
+                    Save the histograms of every image to a .npz file.
+  --workers=N       Number of worker processes (default: number of cores).
+  --chunk-size=N    Number of images to send to a worker at once
+                    [default: 32].
   --debug           Write debug output.
   -h --help         Show this screen.
   --version         Show version.
 """
 
+import csv
+import json
 import logging
 import os.path
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import cv2
 from docopt import docopt
 
+import label_image
+import workerpool
+
 
 DEBUG = False
 
+# dilate to account for almost right predictions,
+# the same as three iterations with a 3x3 kernel
+KERNEL = np.ones((7, 7), np.uint8)
 
-def calculate_diff(label_list, thresh):
-    with open(label_list) as f:
+# number of intensities of the predictions
+BINS = 256
+
+# threads per worker that read the next images
+READ_THREADS = 2
+
+# state of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(settings):
+    _worker.update(settings)
+    _worker['buffers'] = {}
+    _worker['reader'] = ThreadPoolExecutor(READ_THREADS)
+
+
+def _buffer(name, shape, dtype=bool):
+    """Returns a preallocated array that is reused for images of all
+    sizes of a worker.
+    """
+    size = shape[0] * shape[1]
+    buf = _worker['buffers'].get(name)
+    if buf is None or buf.size < size:
+        buf = np.empty(size, dtype)
+        _worker['buffers'][name] = buf
+    return buf[:size].reshape(shape)
+
+
+def read_pair(where, line, labels, json_dir=None):
+    """Reads the prediction and the ground truth (as black and white image
+    at the size of the prediction). Returns None if a file is missing.
+    """
+
+    pred = os.path.join(where, line.strip())
+    name = os.path.basename(pred)[:-14]
+    fname = name + "-label.png"
+    truth = os.path.join(where, fname)
+    if name not in labels and json_dir:
+        truth = os.path.join(json_dir, name + ".json")
+
+    if not os.path.isfile(pred) or (
+            name not in labels and not os.path.isfile(truth)):
+        print("Not found:", pred, truth)
+        return None
+
+    pred = cv2.imread(pred, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+    h, w = pred.shape
+
+    if name in labels:
+        # already black and white at the predicted image size
+        truth = label_image.decode_label(labels[name], (h, w))
+    elif json_dir:
+        with open(truth) as f:
+            truth = label_image.synthesize_label(json.load(f), (h, w))
+    else:
+        truth = cv2.imread(truth, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+
+        # resize to predicted image size
+        truth = cv2.resize(truth, (w, h))
+
+        # threshold because of scaling interpolation
+        _, truth = cv2.threshold(truth, 127, 255, cv2.THRESH_BINARY)
+
+    return pred, truth
+
+
+def histograms(pred, truth):
+    """Counts the pixels of a prediction (gray) by their intensity. Returns
+    an array with three histograms: of the prediction on the truth, of the
+    prediction outside of the dilated truth and of the dilated prediction on
+    the truth.
+    """
+
+    shape = pred.shape
+    truth = np.greater(truth, 0, out=_buffer('truth', shape))
+    truth_dil = np.greater(cv2.dilate(truth.view(np.uint8), KERNEL), 0,
+                           out=_buffer('truth_dil', shape))
+
+    # thresholding commutes with dilation, so the dilated prediction
+    # gives the dilated black and white prediction for every threshold
+    pred_dil = cv2.dilate(pred, KERNEL)
+
+    hist = np.empty((3, BINS), np.int64)
+    hist[0] = np.bincount(pred[truth], minlength=BINS)
+    hist[1] = (np.bincount(pred.ravel(), minlength=BINS) -
+               np.bincount(pred[truth_dil], minlength=BINS))
+    hist[2] = np.bincount(pred_dil[truth], minlength=BINS)
+
+    if DEBUG:
+        thresh = _worker['thresholds'][0]
+        bw = pred > thresh
+        print(counts(hist, [thresh])[0])
+
+        cv2.imshow('truth', truth.astype(np.uint8) * 255)
+        cv2.imshow('predicted', bw.astype(np.uint8) * 255)
+
+        cv2.imshow('fp', (bw & ~truth_dil).astype(np.uint8) * 255)
+        cv2.imshow('fn', (truth & ~(pred_dil > thresh)).astype(np.uint8) * 255)
+        cv2.imshow('tp', (bw & truth).astype(np.uint8) * 255)
+
+        cv2.moveWindow('truth', 100, 10)
+        cv2.moveWindow('predicted', 300, 10)
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+
+    return hist
 
-        all_fp = 0.0
-        all_fn = 0.0
-        all_tp = 0.0
 
-        where = os.path.dirname(label_list)
-        for line in f:
-            pred = os.path.join(where, line.strip())
-            fname = os.path.basename(
-                pred)[:-14] + "-label.png"
-            truth = os.path.join(where, fname)
+def counts(hist, thresholds):
+    """Returns the true positive, false positive and false negative pixels
+    (one row per threshold) from the histograms of an image or of the sum
+    of many images. A pixel is predicted if it is brighter than the
+    threshold.
+    """
 
-            if not os.path.isfile(pred) or not os.path.isfile(truth):
-                print("Not found:", pred, truth)
-                continue
+    # pixels brighter than each intensity
+    brighter = np.zeros_like(hist)
+    brighter[:, :-1] = hist[:, :0:-1].cumsum(axis=1)[:, ::-1]
 
-            truth = cv2.imread(truth, cv2.CV_LOAD_IMAGE_GRAYSCALE)
-            pred = cv2.imread(pred, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+    thresholds = np.asarray(thresholds)
+    tp = brighter[0, thresholds]
+    fp = brighter[1, thresholds]
+    fn = hist[2].sum() - brighter[2, thresholds]
+    return np.stack([tp, fp, fn], axis=-1)
 
-            # resize to predicted image size
-            h, w = pred.shape
-            truth = cv2.resize(truth, (w, h))
 
-            # threshold to get bw image
-            _, pred = cv2.threshold(pred, thresh, 255, cv2.THRESH_BINARY)
+def _compare_chunk(lines):
+    """Compares the images in a chunk of the list. The next images are read
+    while the current ones are compared.
 
-            # threshold because of scaling interpolation
-            _, truth = cv2.threshold(truth, 127, 255, cv2.THRESH_BINARY)
+    Returns the histograms summed over the chunk and the name, shape,
+    counts (see counts) and histograms of every compared image.
+    """
 
-            # dilate to account for almost right predictions (see alternative below)
-            kernel = np.ones((3, 3), np.uint8)
-            truth_dil = cv2.dilate(truth, kernel, iterations=3)
-            pred_dil = cv2.dilate(pred, kernel, iterations=3)
+    where = _worker['where']
+    labels = _worker['labels']
+    json_dir = _worker['json_dir']
+    thresholds = _worker['thresholds']
 
-            # no dilation
-            # truth_dil = truth
-            # pred_dil = pred
+    hist = np.zeros((3, BINS), np.int64)
+    images = []
 
-            fp = np.sum(pred - truth_dil)
-            fn = np.sum(truth - pred_dil)
-            tp = np.sum(cv2.bitwise_and(pred, truth))
+    pairs = _worker['reader'].map(
+        lambda line: read_pair(where, line, labels, json_dir), lines)
+    for line, pair in zip(lines, pairs):
+        if pair is None:
+            continue
+        pred, truth = pair
+        image_hist = histograms(pred, truth)
+        hist += image_hist
+        images.append((line.strip(), pred.shape,
+                       counts(image_hist, thresholds), image_hist))
 
-            all_fp += fp
-            all_fn += fn
-            all_tp += tp
+    return hist, images
 
-            if DEBUG:
-                print(fn, fp, tp)
 
-                cv2.imshow('truth', truth)
-                cv2.imshow('predicted', pred)
+def scores(tp, fp, fn):
+    """Returns precision, recall and F1 score."""
+    precision = tp / float(tp + fp) if tp + fp else 0.0
+    recall = tp / float(tp + fn) if tp + fn else 0.0
+    f1 = 0.0
+    if precision + recall:
+        f1 = 2 * precision * recall / (precision + recall)
+    return precision, recall, f1
 
-                cv2.imshow('fp', pred - truth_dil)
-                cv2.imshow('fn', truth - pred_dil)
-                cv2.imshow('tp', cv2.bitwise_and(pred, truth))
 
-                cv2.moveWindow('truth', 100, 10)
-                cv2.moveWindow('predicted', 300, 10)
-                cv2.waitKey(0)
-                cv2.destroyAllWindows()
+def write_csv(csv_file, header, rows):
+    with open(csv_file, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
 
-        print("Shape:", h, w)
-        print(all_fp, all_fn, all_tp)
 
-        precision = all_tp / (all_tp + all_fp)
-        recall = all_tp / (all_tp + all_fn)
+def metrics_rows(thresholds, counts):
+    """Rows of threshold, tp, fp, fn, precision, recall and F1 score."""
+    for t, (tp, fp, fn) in zip(thresholds, counts):
+        yield (t, tp, fp, fn) + tuple(
+            round(s, 6) for s in scores(tp, fp, fn))
 
+
+METRICS_HEADER = ['threshold', 'tp', 'fp', 'fn', 'precision', 'recall', 'f1']
+
+
+def write_histograms(histograms_file, names, shapes, hists):
+    """Saves the histograms of the images as an (N, 3, BINS) array."""
+    np.savez_compressed(histograms_file, names=np.array(names, str),
+                        shapes=np.array(shapes, int).reshape(-1, 2),
+                        histograms=np.array(hists, np.int64).reshape(
+                            -1, 3, BINS))
+
+
+def read_histograms(histograms_file):
+    """Returns the names, shapes and histograms of write_histograms."""
+    with np.load(histograms_file) as data:
+        return list(data['names']), data['shapes'], data['histograms']
+
+
+def image_rows(name, shape, thresholds, image_counts):
+    return [(name, shape[0], shape[1]) + row
+            for row in metrics_rows(thresholds, image_counts)]
+
+
+def report(hist, thresholds, curve_file=None):
+    """Prints the metrics of the summed histograms for the thresholds."""
+    if curve_file:
+        write_csv(curve_file, METRICS_HEADER,
+                  metrics_rows(range(BINS - 1), counts(hist, range(BINS - 1))))
+
+    total = counts(hist, thresholds)
+    if len(thresholds) == 1:
+        tp, fp, fn = total[0]
+        print(fp, fn, tp)
+
+        precision, recall, f1 = scores(tp, fp, fn)
         print("Precision:", precision)
         print("Recall:", recall)
-        print("F1 score:", 2 * precision * recall / (precision + recall))
+        print("F1 score:", f1)
+    else:
+        print("Threshold\tPrecision\tRecall\tF1 score")
+        for t, (tp, fp, fn) in zip(thresholds, total):
+            print("{}\t{:.4f}\t{:.4f}\t{:.4f}".format(t, *scores(tp, fp, fn)))
+
+
+def check_thresholds(thresh):
+    thresholds = thresh if isinstance(thresh, (list, tuple)) else [thresh]
+    for t in thresholds:
+        if not 0 <= t < BINS:
+            raise ValueError('Threshold {} is not between 0 and {}'.format(
+                t, BINS - 1))
+    return thresholds
+
+
+def calculate_diff(label_list, thresh, labels=None, workers=None,
+                   chunk_size=32, csv_file=None, curve_file=None,
+                   json_dir=None, histograms_file=None):
+    """Compares predictions with the ground truth. If a dict of label
+    records (see label_image.read_labels) is given, the ground truth is
+    decoded from there at the size of the prediction. With json_dir, it is
+    computed from the JSON of the figures (see label_image.synthesize_label)
+    instead of reading label images.
 
+    thresh can be one threshold or a list of thresholds. The metrics of
+    every image are written to csv_file, the metrics for all thresholds
+    to curve_file and the histograms of every image to histograms_file (see
+    rate_histograms). Returns the summed histograms (see histograms).
+    """
+    labels = labels or {}
+    thresholds = check_thresholds(thresh)
+
+    with open(label_list) as f:
+        lines = [line for line in f if line.strip()]
+
+    settings = {
+        'where': os.path.dirname(label_list),
+        'labels': labels,
+        'thresholds': thresholds,
+        'json_dir': json_dir,
+    }
+    results = workerpool.imap(
+        _compare_chunk, workerpool.chunks(lines, chunk_size),
+        0 if DEBUG or workers == 1 else workers, _init_worker, (settings,),
+        ordered=True)
+
+    hist = np.zeros((3, BINS), np.int64)
+    compared = 0
+    smallest, largest = None, None
+    rows = []
+    names, shapes, hists = [], [], []
+    start = time.time()
+    try:
+        for chunk_hist, images in results:
+            hist += chunk_hist
+            compared += len(images)
+            for name, shape, image_counts, image_hist in images:
+                smallest = min(smallest or shape, shape, key=np.prod)
+                largest = max(largest or shape, shape, key=np.prod)
+                if csv_file:
+                    rows.extend(image_rows(name, shape, thresholds,
+                                           image_counts))
+                if histograms_file:
+                    names.append(name)
+                    shapes.append(shape[:2])
+                    hists.append(image_hist)
+            workerpool.progress(compared, len(lines), 'images', start)
+    finally:
+        results.close()
+    sys.stderr.write("\n")
+
+    if histograms_file:
+        write_histograms(histograms_file, names, shapes, hists)
+
+    if not compared:
+        print("No images compared")
+        return hist
+
+    print("Compared {} images, smallest {}x{}, largest {}x{}".format(
+        compared, smallest[0], smallest[1], largest[0], largest[1]))
+
+    if csv_file:
+        write_csv(csv_file, ['name', 'height', 'width'] + METRICS_HEADER, rows)
+    report(hist, thresholds, curve_file)
+    return hist
+
+
+def rate_histograms(histograms_file, thresh, csv_file=None, curve_file=None):
+    """Computes the metrics again from the histograms of calculate_diff.
+    Returns the summed histograms.
+    """
+    thresholds = check_thresholds(thresh)
+    names, shapes, hists = read_histograms(histograms_file)
+    print("Read the histograms of {} images".format(len(names)))
+
+    if csv_file:
+        rows = []
+        for name, shape, image_hist in zip(names, shapes, hists):
+            rows.extend(image_rows(name, shape, thresholds,
+                                   counts(image_hist, thresholds)))
+        write_csv(csv_file, ['name', 'height', 'width'] + METRICS_HEADER, rows)
+
+    hist = hists.sum(axis=0)
+    report(hist, thresholds, curve_file)
+    return hist
 
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='Tester 1.0')
@@ -107,5 +393,23 @@ if __name__ == '__main__':
         logging.basicConfig(level=logging.DEBUG)
         DEBUG = True
 
-    calculate_diff(arguments['LIST'],
-                   int(arguments['--thresh']))
+    labels = {}
+    for labels_file in arguments['--labels']:
+        labels.update(label_image.read_labels(labels_file))
+
+    workers = None
+    if arguments['--workers']:
+        workers = int(arguments['--workers'])
+
+    thresholds = [int(t) for t in arguments['--thresh'].split(',')]
+    try:
+        if arguments['histograms']:
+            rate_histograms(arguments['FILE'], thresholds, arguments['--csv'],
+                            arguments['--curve'])
+        else:
+            calculate_diff(arguments['LIST'], thresholds, labels, workers,
+                           int(arguments['--chunk-size']), arguments['--csv'],
+                           arguments['--curve'], arguments['--json'],
+                           arguments['--histograms'])
+    except ValueError as e:
+        sys.exit(str(e))
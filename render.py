@@ -1,30 +1,303 @@
-from wand.image import Image
-from wand.color import Color
+"""Render figures from pdf files.
 
+Compare pages that are downsampled from a high resolution rendering with
+pages that are rendered natively at the lower resolution:
 
-def render_chart(pdf_file, page, bounds, dpi, target):
-    """Renders part of a pdf file with imagemagick.
+Usage:
+  render.py compare FILE [--dpi=DPI] [--source-dpi=DPI] [--renderer=NAME]
+  render.py
+  render.py (-h | --help)
+
+Options:
+  --dpi=DPI          Resolution to compare at [default: 100].
+  --source-dpi=DPI   Resolution to downsample from [default: 200].
+  --renderer=NAME    Backend to rasterize pages with (wand or mupdf)
+                     [default: wand].
+  -h --help          Show this screen.
+"""
+
+import os
+import collections
+
+import numpy as np
+import cv2
+from docopt import docopt
+
+import metrics
+
+
+# maximum number of bytes of rasterized pages to keep around
+CACHE_SIZE = 256 * 1024 * 1024
+
+# versions of the backends by class, see renderer_version
+_versions = {}
+
+
+class WandRenderer(object):
+    """Rasterizes pages with imagemagick, which calls ghostscript."""
+
+    def __init__(self):
+        self._image, self._color = self._import()
+
+    @staticmethod
+    def _import():
+        # only needed for this backend
+        from wand.image import Image
+        from wand.color import Color
+        return Image, Color
+
+    def rasterize(self, pdf_file, page, dpi):
+        """Renders a whole page of a pdf file.
+        Returns the page as a BGR numpy array on a white background.
+        """
+
+        Image, Color = self._image, self._color
+        pdf_page = pdf_file + '[{}]'.format(page)
+        with Image(filename=pdf_page, resolution=dpi) as img:
+            # put transparent image on white background
+            with Image(width=img.width, height=img.height,
+                       background=Color("white")) as bg:
+                bg.composite(img, 0, 0)
+                bg.depth = 8
+                blob = bg.make_blob(format='RGB')
+                pixels = np.frombuffer(blob, np.uint8).reshape(
+                    bg.height, bg.width, 3)
+
+        return cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR)
+
+    @classmethod
+    def version(cls):
+        from wand.version import MAGICK_VERSION
+        return MAGICK_VERSION
+
+    def page_count(self, pdf_file):
+        with self._image(filename=pdf_file, resolution=10) as pdf:
+            return len(pdf.sequence)
+
+    def close(self):
+        pass
+
+
+class MuPdfRenderer(object):
+    """Rasterizes pages in-process with MuPDF (PyMuPDF).
+
+    There are no subprocesses or temporary files and the pixels are handed
+    over directly. The last used document is kept open.
+    """
+
+    def __init__(self):
+        self._fitz = self._import()
+        self._path = None
+        self._doc = None
+
+    @staticmethod
+    def _import():
+        # optional dependency, only needed for this backend
+        try:
+            import pymupdf as fitz
+        except ImportError:
+            import fitz
+        return fitz
+
+    @classmethod
+    def version(cls):
+        return 'PyMuPDF {}'.format(cls._import().VersionBind)
+
+    def _open(self, pdf_file):
+        if pdf_file != self._path:
+            self.close()
+            self._doc = self._fitz.open(pdf_file)
+            self._path = pdf_file
+        return self._doc
+
+    def rasterize(self, pdf_file, page, dpi):
+        """Renders a whole page of a pdf file.
+        Returns the page as a BGR numpy array on a white background.
+        """
+
+        pdf_page = self._open(pdf_file)[page]
+
+        # pdf coordinates are in points (1/72 inch)
+        zoom = dpi/72.0
+        matrix = self._fitz.Matrix(zoom, zoom)
+
+        # older versions of PyMuPDF use camel case names
+        get_pixmap = getattr(pdf_page, 'get_pixmap', None) or pdf_page.getPixmap
+        pix = get_pixmap(matrix=matrix, alpha=False)
+
+        pixels = np.frombuffer(pix.samples, np.uint8).reshape(
+            pix.height, pix.width, pix.n)
+
+        if pix.n == 1:
+            return cv2.cvtColor(pixels, cv2.COLOR_GRAY2BGR)
+        return cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR)
+
+    def page_count(self, pdf_file):
+        return len(self._open(pdf_file))
+
+    def close(self):
+        if self._doc is not None:
+            self._doc.close()
+        self._doc = None
+        self._path = None
+
+
+RENDERERS = {
+    'wand': WandRenderer,
+    'mupdf': MuPdfRenderer,
+}
+
+
+def get_renderer(name='wand'):
+    """Creates the rendering backend with the given name."""
+    if name not in RENDERERS:
+        raise ValueError('Unknown renderer {}. Use one of {}.'.format(
+            name, ', '.join(sorted(RENDERERS))))
+    return RENDERERS[name]()
+
+
+def renderer_version(renderer_class):
+    """Returns the version of a backend, looked up once per process."""
+    if renderer_class not in _versions:
+        _versions[renderer_class] = renderer_class.version()
+    return _versions[renderer_class]
+
+
+def downsample(pixels, dpi, source_dpi):
+    """Downsamples a page rendered at source_dpi to dpi by averaging
+    the pixel areas that make up each output pixel.
+    """
+
+    h, w = pixels.shape[:2]
+    scale = 1.0*dpi/source_dpi
+    size = (int(round(w*scale)), int(round(h*scale)))
+    return cv2.resize(pixels, size, interpolation=cv2.INTER_AREA)
+
+
+class PageCache(object):
+    """Keeps rasterized pages in memory so that all figures on a page
+    can be cropped from one rendering.
+
+    Pages are keyed by (pdf file, page, dpi). If the cached pages take up
+    more than `max_bytes`, the least recently used pages are evicted.
+    Missing pages are rasterized with the given renderer (default: wand).
+    """
+
+    def __init__(self, max_bytes=CACHE_SIZE, renderer=None):
+        self.max_bytes = max_bytes
+        self.renderer = renderer or WandRenderer()
+        self.size = 0
+        self._pages = collections.OrderedDict()
+
+    def get(self, pdf_file, page, dpi, source_dpi=None):
+        """Returns the page rendered at dpi. If source_dpi is higher than
+        dpi, the page is downsampled from a rendering at source_dpi instead
+        of rasterizing it again.
+        """
+
+        key = (os.path.abspath(pdf_file), page, dpi)
+
+        pixels = self._pages.pop(key, None)
+        if pixels is None:
+            if source_dpi and source_dpi > dpi:
+                source = self.get(pdf_file, page, source_dpi)
+                with metrics.timer('downsample', dpi=dpi):
+                    pixels = downsample(source, dpi, source_dpi)
+            else:
+                with metrics.timer('rasterize', dpi=dpi):
+                    pixels = self.renderer.rasterize(pdf_file, page, dpi)
+            self.size += pixels.nbytes
+
+        # (re-)insert as most recently used
+        self._pages[key] = pixels
+
+        # never evict the page we are about to return
+        while self.size > self.max_bytes and len(self._pages) > 1:
+            _, evicted = self._pages.popitem(last=False)
+            self.size -= evicted.nbytes
+
+        return pixels
+
+    def clear(self):
+        self._pages.clear()
+        self.size = 0
+
+
+def crop(pixels, bounds, dpi):
+    """Crops the bounds (given at 100 DPI) from a page rendered at dpi."""
+
+    factor = 1.0*dpi/100
+
+    x0 = bounds[0]
+    y0 = bounds[1]
+    w = bounds[2] - x0
+    h = bounds[3] - y0
+
+    left = max(0, int(x0*factor))
+    top = max(0, int(y0*factor))
+
+    return pixels[top:top + int(h*factor), left:left + int(w*factor)]
+
+
+def render_chart(pdf_file, page, bounds, dpi, target, cache=None,
+                 source_dpi=None):
+    """Renders part of a pdf file.
     Pass this function the bounds and resolution.
+
+    If a PageCache is passed, the page is only rasterized (with the
+    renderer of the cache) if it is not in the cache yet. If source_dpi
+    is set, the page is rendered at source_dpi and downsampled to dpi.
+
+    Returns the rendered chart as a BGR numpy array so that it can be used
+    without reading the image back from disk.
     """
 
-    pdf_page = pdf_file + '[{}]'.format(page)
-    with Image(filename=pdf_page, resolution=dpi) as img:
-        factor = 1.0*dpi/100
+    if cache is None:
+        cache = PageCache()
+    pixels = cache.get(pdf_file, page, dpi, source_dpi)
+
+    chart = crop(pixels, bounds, dpi)
+    with metrics.timer('encode_png', output='image', dpi=dpi):
+        cv2.imwrite(target, chart)
+    return chart
+
+
+def downsample_error(pdf_file, page, dpi, source_dpi, renderer=None):
+    """Compares a page downsampled from source_dpi with the page rendered
+    natively at dpi. Returns the mean and the 99th percentile of the
+    absolute gray value difference (0-255).
+    """
 
-        x0 = bounds[0]
-        y0 = bounds[1]
-        w = bounds[2] - x0
-        h = bounds[3] - y0
+    renderer = renderer or WandRenderer()
+    native = renderer.rasterize(pdf_file, page, dpi)
+    down = downsample(renderer.rasterize(pdf_file, page, source_dpi),
+                      dpi, source_dpi)
 
-        img.crop(left=int(x0*factor), top=int(y0*factor),
-                 width=int(w*factor), height=int(h*factor))
+    # the renderings may differ by a pixel because of rounding
+    h = min(native.shape[0], down.shape[0])
+    w = min(native.shape[1], down.shape[1])
+
+    native = cv2.cvtColor(native[:h, :w], cv2.COLOR_BGR2GRAY)
+    down = cv2.cvtColor(down[:h, :w], cv2.COLOR_BGR2GRAY)
+    diff = cv2.absdiff(native, down)
+
+    return np.mean(diff), np.percentile(diff, 99)
 
-        # put transparent image on white background
-        with Image(width=img.width, height=img.height,
-                   background=Color("white")) as bg:
-            bg.composite(img, 0, 0)
-            bg.save(filename=target)
 
 if __name__ == '__main__':
-    render_chart('testdata/paper.pdf', 1,
-                 [100, 200, 500, 500], 200, '/tmp/rendered_region_2x.png')
+    arguments = docopt(__doc__)
+
+    if arguments['compare']:
+        renderer = get_renderer(arguments['--renderer'])
+        pages = renderer.page_count(arguments['FILE'])
+
+        dpi = int(arguments['--dpi'])
+        source_dpi = int(arguments['--source-dpi'])
+        for page in range(pages):
+            mean, p99 = downsample_error(arguments['FILE'], page,
+                                         dpi, source_dpi, renderer)
+            print("Page {}: mean difference {:.2f}, 99th percentile {:.0f}".format(
+                page, mean, p99))
+    else:
+        render_chart('testdata/paper.pdf', 1,
+                     [100, 200, 500, 500], 200, '/tmp/rendered_region_2x.png')
@@ -0,0 +1,76 @@
+"""Helpers to use S3 from several threads.
+
+By default, we connect to AWS. To test against a local stand-in such as
+moto (`moto_server s3 -p 5000`) or MinIO, set `s3_host` and `s3_port`
+in the config.
+"""
+
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+from boto.s3.key import Key
+
+import config
+
+
+_local = threading.local()
+
+
+def connect():
+    host = getattr(config, 's3_host', None)
+    if host:
+        return S3Connection(config.access_key, config.secret_key,
+                            is_secure=False, host=host,
+                            port=getattr(config, 's3_port', None),
+                            calling_format=OrdinaryCallingFormat())
+    return S3Connection(config.access_key, config.secret_key, is_secure=False)
+
+
+def get_bucket(name):
+    """Returns a bucket on a connection that belongs to the calling thread.
+    Connections and buckets are reused for all calls from the same thread.
+    """
+
+    if not hasattr(_local, 'conn'):
+        _local.conn = connect()
+        _local.buckets = {}
+
+    if name not in _local.buckets:
+        _local.buckets[name] = _local.conn.get_bucket(name)
+    return _local.buckets[name]
+
+
+def read_keys(bucket_name, names, threads=16):
+    """Downloads the contents of many keys with a pool of threads.
+
+    Yields (name, contents, error) in the order of names. At most twice as
+    many requests as threads are in flight, so names can be a lazy listing.
+    """
+
+    def get(name):
+        # a new Key avoids the HEAD request of bucket.get_key
+        return Key(get_bucket(bucket_name), name).get_contents_as_string()
+
+    def finish(item):
+        name, future = item
+        try:
+            return name, future.result(), None
+        except Exception as e:
+            return name, None, e
+
+    executor = ThreadPoolExecutor(threads)
+    pending = collections.deque()
+    try:
+        for name in names:
+            if len(pending) >= 2 * threads:
+                yield finish(pending.popleft())
+            pending.append((name, executor.submit(get, name)))
+
+        while pending:
+            yield finish(pending.popleft())
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
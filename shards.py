@@ -0,0 +1,150 @@
+"""Pack the outputs of label_gen into large tar files (shards).
+
+Reading millions of small files is slow, especially from S3. Instead, the
+images, labels and JSON of many figures are appended to size-bounded tar
+files that can be read sequentially with few requests.
+
+Every shard PREFIX-NNNNN.tar has an index PREFIX-NNNNN.tar.idx with one JSON
+record per member: its name, the figure it belongs to (key) and the offset
+and size of its data in the tar file. With the index, single members can be
+read with a seek or a range request. The files of a figure are stored next
+to each other.
+"""
+
+import os
+import re
+import json
+import socket
+import tarfile
+
+
+# maximum size of a shard before a new one is started
+SHARD_SIZE = 1024 * 1024 * 1024
+
+FIGURE = re.compile('(.*-Figure-[0-9]+)')
+
+
+def sample_key(name):
+    """Returns the figure a file belongs to, e.g. paper-Figure-3 for
+    paper-Figure-3-2x.png. Other files are their own sample.
+    """
+    groups = FIGURE.match(name)
+    if groups:
+        return groups.group(1)
+    return name.split('.')[0]
+
+
+def index_name(tar_file):
+    return tar_file + '.idx'
+
+
+class ShardWriter(object):
+    """Appends files to tar files in a directory and writes their indexes.
+
+    A shard is closed when it is larger than max_bytes after adding the files
+    of a document, so documents are never split across shards. on_close is
+    called with the tar file and the index file of every closed shard.
+    """
+
+    def __init__(self, directory, prefix=None, max_bytes=SHARD_SIZE,
+                 on_close=None):
+        self.directory = directory
+        # unique per process so that several writers can share a directory
+        self.prefix = prefix or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.max_bytes = max_bytes
+        self.on_close = on_close
+        self.count = 0
+
+        self._tar = None
+        self._tar_file = None
+        self._index = []
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _open(self):
+        self._tar_file = os.path.join(self.directory, '{}-{:05d}.tar'.format(
+            self.prefix, self.count))
+        self._tar = tarfile.open(self._tar_file, 'w')
+        self._index = []
+        self.count += 1
+
+    def add_files(self, files):
+        """Appends the files (of one document) to the current shard."""
+
+        if self._tar is None:
+            self._open()
+
+        names = [(sample_key(os.path.basename(f)), os.path.basename(f), f)
+                 for f in files]
+        for key, name, filename in sorted(names):
+            info = self._tar.gettarinfo(filename, arcname=name)
+            with open(filename, 'rb') as f:
+                self._tar.addfile(info, f)
+
+            # the data is followed by padding to the next block
+            blocks = (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+            offset = self._tar.offset - blocks * tarfile.BLOCKSIZE
+
+            self._index.append({
+                'name': name,
+                'key': key,
+                'offset': offset,
+                'size': info.size,
+            })
+
+        if self._tar.offset >= self.max_bytes:
+            self.close_shard()
+
+    def close_shard(self):
+        if self._tar is None:
+            return
+
+        self._tar.close()
+        with open(index_name(self._tar_file), 'w') as f:
+            for record in self._index:
+                f.write(json.dumps(record) + '\n')
+
+        tar_file = self._tar_file
+        self._tar = None
+        self._tar_file = None
+
+        if self.on_close:
+            self.on_close(tar_file, index_name(tar_file))
+
+    def close(self):
+        self.close_shard()
+
+
+def read_index(index_file):
+    """Returns the records of a shard index."""
+    with open(index_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_member(fileobj, record):
+    """Reads the data of one member from an open tar file."""
+    fileobj.seek(record['offset'])
+    return fileobj.read(record['size'])
+
+
+def iter_samples(fileobj):
+    """Reads a shard sequentially from a file object and yields the key
+    and a dict from file names to data for every figure.
+    """
+
+    key = None
+    sample = {}
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            name = os.path.basename(info.name)
+            if sample_key(name) != key and sample:
+                yield key, sample
+                sample = {}
+            key = sample_key(name)
+            sample[name] = tar.extractfile(info).read()
+
+    if sample:
+        yield key, sample
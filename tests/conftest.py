@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import socket
+import threading
+import subprocess
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import config
+except ImportError:
+    # the tests only talk to a local S3 stand-in
+    config = types.ModuleType('config')
+    config.access_key = None
+    config.secret_key = None
+    sys.modules['config'] = config
+
+import s3util
+
+
+BUCKETS = ['inb', 'outb']
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('moto did not start on port {}'.format(port))
+
+
+@pytest.fixture(scope='session')
+def moto_port():
+    """Runs moto as a local S3 server for all tests. Returns its port."""
+
+    port = _free_port()
+    try:
+        from moto.server import create_backend_app
+        from werkzeug.serving import make_server
+    except ImportError:
+        # run the command instead
+        create_backend_app = None
+
+    if create_backend_app:
+        # only S3, moto can mistake signatures of boto for other services
+        server = make_server('localhost', port, create_backend_app('s3'),
+                             threaded=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        stop = server.shutdown
+    else:
+        process = subprocess.Popen(['moto_server', 's3', '-p', str(port)])
+        stop = process.kill
+    _wait_for(port)
+    try:
+        yield port
+    finally:
+        stop()
+
+
+@pytest.fixture
+def s3(moto_port, monkeypatch):
+    """Points s3util at moto with the empty buckets inb and outb. Returns
+    a connection.
+    """
+
+    monkeypatch.setattr(config, 'access_key', 'test', raising=False)
+    monkeypatch.setattr(config, 'secret_key', 'test', raising=False)
+    monkeypatch.setattr(config, 's3_host', 'localhost', raising=False)
+    monkeypatch.setattr(config, 's3_port', moto_port, raising=False)
+    # connections of earlier tests may be configured differently
+    monkeypatch.setattr(s3util, '_local', threading.local())
+
+    conn = s3util.connect()
+    for bucket in conn.get_all_buckets():
+        for key in bucket.list():
+            key.delete()
+        bucket.delete()
+    for name in BUCKETS:
+        conn.create_bucket(name)
+    return conn
+
+
+@pytest.fixture
+def root_dir(monkeypatch):
+    """Runs the test in the root of the repository, where the scripts
+    expect the test data.
+    """
+    monkeypatch.chdir(ROOT)
+    return ROOT
@@ -0,0 +1,129 @@
+import os
+import glob
+
+import numpy as np
+import pytest
+from boto.s3.key import Key
+
+import dataset
+import shards
+
+
+OUTPUT = 'testoutput'
+
+
+def expected_samples(root_dir):
+    """The samples of the test output, read directly."""
+    samples = {}
+    for image_file in glob.glob(os.path.join(root_dir, OUTPUT, 'img', '*.png')):
+        name = os.path.basename(image_file)
+        if not dataset._is_image(name, 1):
+            continue
+        key = shards.sample_key(name)
+        label_file = os.path.join(root_dir, OUTPUT, 'text-masked',
+                                  key + dataset.LABEL_SUFFIX)
+        samples[key] = (dataset._read_file(image_file),
+                        dataset._read_file(label_file))
+    return samples
+
+
+def as_dict(samples):
+    found = {}
+    for key, image, label in samples:
+        assert key not in found
+        found[key] = (image, label)
+    return found
+
+
+def write_shards(root_dir, directory):
+    # the files of a figure are stored together, like label_gen batch does
+    figures = {}
+    for filename in glob.glob(os.path.join(root_dir, OUTPUT, '*', '*')):
+        key = shards.sample_key(os.path.basename(filename))
+        figures.setdefault(key, []).append(filename)
+
+    writer = shards.ShardWriter(directory, max_bytes=64 * 1024)
+    for key in sorted(figures):
+        writer.add_files(sorted(figures[key]))
+    writer.close()
+    return sorted(glob.glob(os.path.join(directory, '*')))
+
+
+def upload(bucket, path, directory):
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            local = os.path.join(dirpath, filename)
+            name = os.path.join(path, os.path.relpath(local, directory))
+            Key(bucket, name).set_contents_from_filename(local)
+
+
+def test_local_directory(root_dir):
+    expected = expected_samples(root_dir)
+    assert len(expected) == 6
+
+    found = as_dict(dataset.open_source(os.path.join(root_dir, OUTPUT),
+                                        threads=2))
+    assert found == expected
+
+    pairs = list(dataset.Dataset(os.path.join(root_dir, OUTPUT),
+                                 fetch_threads=2, decode_threads=2))
+    assert len(pairs) == len(expected)
+    for image, label in pairs:
+        assert image.shape == label.shape
+        assert label.dtype == np.uint8
+
+
+def test_shards(root_dir, tmpdir):
+    directory = str(tmpdir.join('shards'))
+    files = write_shards(root_dir, directory)
+    assert len([f for f in files if f.endswith('.tar')]) > 1
+
+    found = as_dict(dataset.open_source(str(tmpdir), threads=2))
+    assert found == expected_samples(root_dir)
+
+
+def test_crops_have_the_shape(root_dir):
+    pairs = list(dataset.Dataset(os.path.join(root_dir, OUTPUT),
+                                 shuffle=4, seed=1, shape=(64, 96),
+                                 fetch_threads=2, decode_threads=2))
+    assert len(pairs) == 6
+    for image, label in pairs:
+        assert image.shape == (64, 96)
+        assert label.shape == (64, 96)
+
+
+def test_s3(s3, root_dir):
+    bucket = s3.get_bucket('outb')
+    upload(bucket, 'out', os.path.join(root_dir, OUTPUT))
+
+    found = as_dict(dataset.open_source('s3://outb/out', threads=2))
+    assert found == expected_samples(root_dir)
+
+    # labels from the JSON of the figures
+    found = as_dict(dataset.open_source('s3://outb/out', threads=2,
+                                        from_json=True))
+    assert sorted(found) == sorted(expected_samples(root_dir))
+    for image, description in found.values():
+        assert 'ImageText' in description
+
+
+def test_s3_shards(s3, root_dir, tmpdir):
+    directory = str(tmpdir.join('shards'))
+    write_shards(root_dir, directory)
+    upload(s3.get_bucket('outb'), 'out/shards', directory)
+
+    found = as_dict(dataset.open_source('s3://outb/out', threads=2))
+    assert found == expected_samples(root_dir)
+
+    pairs = list(dataset.Dataset('s3://outb/out', fetch_threads=2,
+                                 decode_threads=2))
+    assert len(pairs) == 6
+
+
+def test_decode_missing_image():
+    assert dataset.decode(('x', b'not an image', b'')) is None
+
+
+@pytest.mark.parametrize('shape', ['256x128', '256X128'])
+def test_parse_shape(shape):
+    assert dataset.parse_shape(shape) == (256, 128)
@@ -0,0 +1,84 @@
+import json
+import random
+
+import pytest
+from boto.s3.key import Key
+
+import find_bad
+
+
+PATH = 'fb/json/'
+
+
+def figure(boxes):
+    return {
+        'Page': 1,
+        'ImageBB': [0, 0, 400, 300],
+        'ImageText': [{'Rotation': 0, 'Text': 'x',
+                       'TextBB': [20 + 10 * i, 100, 28 + 10 * i, 110]}
+                      for i in range(boxes)],
+    }
+
+
+@pytest.fixture
+def keys(s3):
+    """Uploads the JSON of good and bad figures with names that start with
+    many different characters. Returns the names.
+    """
+    rng = random.Random(0)
+    bucket = s3.get_bucket('inb')
+    names = []
+    for i in range(60):
+        first = rng.choice(find_bad.KEY_CHARACTERS)
+        name = '{}{}{:03d}-Figure-{}.json'.format(PATH, first, i, i % 3)
+        # every fourth figure has too few text boxes
+        Key(bucket, name).set_contents_from_string(
+            json.dumps(figure(1 if i % 4 == 0 else 5)))
+        names.append(name)
+    # keys outside of the path
+    Key(bucket, 'fb/other.json').set_contents_from_string('{}')
+    Key(bucket, 'fc/json/a-Figure-0.json').set_contents_from_string('{}')
+    return sorted(names)
+
+
+def listing(s3):
+    return [key.name for key in s3.get_bucket('inb').list(PATH)]
+
+
+@pytest.mark.parametrize('of', [1, 2, 3, 7])
+def test_key_ranges_match_listing(s3, keys, of):
+    assert listing(s3) == keys
+
+    ranges = find_bad.key_ranges('inb', PATH, of)
+    assert len(ranges) == of - 1
+
+    bounds = [None] + ranges + [None]
+    parts = [list(find_bad.list_range('inb', PATH, bounds[i], bounds[i + 1]))
+             for i in range(of)]
+    assert sum(parts, []) == keys
+
+    # the parts have (almost) the same size
+    sizes = [len(p) for p in parts]
+    assert max(sizes) - min(sizes) <= 1
+
+
+@pytest.mark.parametrize('of', [1, 4])
+def test_prefix_ranges_match_listing(s3, keys, of):
+    ranges = find_bad.prefix_ranges(PATH, of)
+    bounds = [None] + ranges + [None]
+    parts = [list(find_bad.list_range('inb', PATH, bounds[i], bounds[i + 1]))
+             for i in range(of)]
+    assert sum(parts, []) == keys
+
+
+def test_run_s3_chunks_find_the_same_figures(s3, keys, capsys):
+    find_bad.run_s3('inb', PATH, 0, 1)
+    expected = capsys.readouterr().out.split()
+    assert len(expected) == 15
+
+    ranges = find_bad.key_ranges('inb', PATH, 3)
+    found = []
+    for chunk in range(3):
+        find_bad.run_s3('inb', PATH, chunk, 3, ranges)
+        found.extend(capsys.readouterr().out.split())
+    assert found == expected
@@ -0,0 +1,53 @@
+import sys
+import runpy
+
+import pytest
+from boto.exception import S3ResponseError
+
+import label_gen
+import render
+
+
+def available_renderer():
+    for name in ['mupdf', 'wand']:
+        try:
+            render.get_renderer(name).close()
+            return name
+        except ImportError:
+            pass
+    pytest.skip('no renderer installed')
+
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['label_gen.py'] + list(args))
+    runpy.run_path(label_gen.__file__, run_name='__main__')
+
+
+def test_describe_error():
+    assert label_gen.describe_error(ValueError('first\nsecond')) == 'first'
+    assert label_gen.describe_error(ValueError(' \n ')) == 'ValueError'
+    assert label_gen.describe_error(KeyError()) == 'KeyError'
+
+
+def test_read_s3_raises_missing_document(s3, monkeypatch, root_dir):
+    with pytest.raises(S3ResponseError):
+        run_main(monkeypatch, 'read-s3', 'inb', 'pdf/missing.pdf', 'outb',
+                 'out', '--renderer={}'.format(available_renderer()))
+
+
+def test_batch_exits_with_failures(s3, monkeypatch, root_dir, tmpdir):
+    names = tmpdir.join('list.txt')
+    names.write('pdf/missing.pdf\npdf/other.pdf\n')
+
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(monkeypatch, 'batch', str(names), 'out', '--s3-in=inb',
+                 '--s3-out=outb', '--workers=0',
+                 '--renderer={}'.format(available_renderer()))
+    assert exit_info.value.code == 1
+
+
+def test_run_batch_counts_failures(s3, root_dir, tmpdir):
+    failed = label_gen.run_batch(
+        ['pdf/missing.pdf'], 'out', 'inb', 'outb', 0, False, False,
+        available_renderer())
+    assert failed == 1
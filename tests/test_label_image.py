@@ -0,0 +1,59 @@
+import os
+import json
+import glob
+import random
+
+import numpy as np
+import pytest
+
+import label_image
+
+
+JSON_FILES = sorted(glob.glob(os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'testoutput', 'json', '*.json')))
+
+
+def synthetic_figure(boxes, seed):
+    """A figure with many text boxes, some of them at or over its edges."""
+    rng = random.Random(seed)
+    x, y, w, h = 37.5, 112.25, 301.0, 187.0
+    texts = []
+    for _ in range(boxes):
+        x0 = rng.uniform(x - 10, x + w)
+        y0 = rng.uniform(y - 10, y + h)
+        texts.append({'Rotation': 0, 'Text': 'x', 'TextBB': [
+            x0, y0, x0 + rng.uniform(0.5, 40), y0 + rng.uniform(0.5, 12)]})
+    return {'Page': 1, 'ImageBB': [x, y, x + w, y + h], 'ImageText': texts}
+
+
+def test_has_test_figures():
+    assert len(JSON_FILES) == 6
+
+
+@pytest.mark.parametrize('json_file', JSON_FILES,
+                         ids=[os.path.basename(f) for f in JSON_FILES])
+def test_synthesize_label_matches_gen_label(json_file):
+    with open(json_file) as f:
+        description = json.load(f)
+
+    expected = label_image.gen_label(description)
+    assert np.array_equal(label_image.synthesize_label(description), expected)
+    assert np.array_equal(label_image.synthesize_label(
+        description, label_image.label_shape(description)), expected)
+
+
+@pytest.mark.parametrize('boxes', [1, 5, label_image.FEW_BOXES, 200])
+def test_synthesize_label_matches_gen_label_synthetic(boxes):
+    for seed in range(5):
+        description = synthetic_figure(boxes, seed)
+        assert np.array_equal(label_image.synthesize_label(description),
+                              label_image.gen_label(description))
+
+
+def test_synthesize_label_without_text():
+    description = synthetic_figure(0, 0)
+    assert label_image.gen_label(description) is None
+    label = label_image.synthesize_label(description, (20, 30))
+    assert label.shape == (20, 30)
+    assert not label.any()
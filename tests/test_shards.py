@@ -0,0 +1,67 @@
+import os
+
+import shards
+
+
+def write_document(directory, ident, figures):
+    files = []
+    for i in range(figures):
+        for suffix in ['.json', '.png', '-2x.png', '-label.png']:
+            name = os.path.join(directory, '{}-Figure-{}{}'.format(
+                ident, i, suffix))
+            with open(name, 'wb') as f:
+                f.write(os.urandom(100 + 37 * i) + name.encode('utf-8'))
+            files.append(name)
+    return files
+
+
+def read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def test_round_trip(tmpdir):
+    inputs = tmpdir.mkdir('in')
+    closed = []
+    writer = shards.ShardWriter(str(tmpdir.join('shards')), prefix='test',
+                                max_bytes=8 * 1024,
+                                on_close=lambda *f: closed.append(f))
+
+    documents = {}
+    for ident, figures in [('a', 3), ('b', 1), ('c', 4)]:
+        files = write_document(str(inputs), ident, figures)
+        documents[ident] = files
+        writer.add_files(files)
+    writer.close()
+
+    # documents are never split, so every shard has whole figures
+    assert len(closed) > 1
+    expected = dict((os.path.basename(f), read(f))
+                    for files in documents.values() for f in files)
+
+    found = {}
+    for tar_file, index_file in closed:
+        records = shards.read_index(index_file)
+        with open(tar_file, 'rb') as f:
+            for record in records:
+                data = shards.read_member(f, record)
+                assert data == expected[record['name']]
+                assert record['key'] == shards.sample_key(record['name'])
+
+            f.seek(0)
+            for key, sample in shards.iter_samples(f):
+                assert all(shards.sample_key(n) == key for n in sample)
+                assert key not in found
+                found[key] = sample
+
+    assert sorted(found) == sorted(set(map(shards.sample_key, expected)))
+    for key, sample in found.items():
+        for name, data in sample.items():
+            assert data == expected[name]
+        assert len(sample) == 4
+
+
+def test_sample_key():
+    assert shards.sample_key('paper-Figure-3-2x.png') == 'paper-Figure-3'
+    assert shards.sample_key('paper-Figure-12.json') == 'paper-Figure-12'
+    assert shards.sample_key('paper-labels.jsonl') == 'paper-labels'
@@ -0,0 +1,70 @@
+"""Pools of long-running worker processes for the batch commands.
+
+Every worker is set up once with an initializer, like multiprocessing.Pool,
+which usually stores the settings of the batch in a global of the module:
+
+  _worker = {}
+
+  def _init_worker(settings):
+      _worker.update(settings)
+
+  for result in workerpool.imap(_detect, pairs, workers, _init_worker,
+                                (settings,)):
+      ...
+"""
+
+import sys
+import time
+import multiprocessing
+
+
+def imap(function, items, workers=None, initializer=None, initargs=(),
+         chunk_size=1, ordered=False):
+    """Yields function(item) for all items, computed by a pool of workers
+    that are set up with initializer(*initargs) (or in this process if
+    workers is 0).
+    """
+
+    if workers == 0:
+        if initializer:
+            initializer(*initargs)
+        for item in items:
+            yield function(item)
+        return
+
+    pool = multiprocessing.Pool(workers, initializer, initargs)
+    try:
+        if ordered:
+            results = pool.imap(function, items, chunk_size)
+        else:
+            results = pool.imap_unordered(function, items, chunk_size)
+        for result in results:
+            yield result
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def rate(count, start):
+    """Returns the items per second since start."""
+    return count / max(time.time() - start, 1e-9)
+
+
+def progress(done, total, unit, start, detail=None, end='\r'):
+    """Writes how many items are done and the throughput to stderr."""
+    sys.stderr.write('[{}/{}] {}{:.2f} {}/s{}'.format(
+        done, total, detail + ', ' if detail else '', rate(done, start),
+        unit, end))
+
+
+def summary(verb, count, unit, start, failed=None):
+    """Writes the number of items and the throughput of a batch to stderr."""
+    sys.stderr.write('{} {} {}{} in {:.1f}s, {:.2f} {}/s\n'.format(
+        verb, count, unit,
+        '' if failed is None else ' ({} failed)'.format(failed),
+        time.time() - start, rate(count, start), unit))